@@ -0,0 +1,525 @@
+#!/usr/bin/python3
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+# A local stand-in for the parts of Azure DevOps this project calls. Requests arrive as /<host>/<path>,
+# which is what AdoTransport sends when PROJECT_SETUP_ADO_ENDPOINT points here.
+
+DEFAULT_POOL_NAME = 'Azure Pipelines'
+FAKE_HOSTS = ['dev.azure.com', 'vsrm.dev.azure.com', 'vssps.dev.azure.com', 'vsaex.dev.azure.com']
+
+RESOURCE_AREAS = {
+    '79134c72-4a58-4b42-976c-04e7115f32bf': ('core', 'dev.azure.com'),
+    '4e080c62-fa21-4fbc-8fef-2a10a2b38049': ('git', 'dev.azure.com'),
+    '965220d5-5bb9-42cf-8d67-9b146df2a5a4': ('build', 'dev.azure.com'),
+    'a85b8835-c1a1-4aac-ae97-1c3d0ba72dbd': ('distributedtask', 'dev.azure.com'),
+    'efc2f575-36ef-48e9-b672-0c6fb4a48ac5': ('Release', 'vsrm.dev.azure.com'),
+}
+
+# The SDK clients look their routes up by location id through an OPTIONS request
+LOCATIONS = [
+    ('e81700f7-3be2-46de-8624-2eb35882fcaa', 'Location', 'ResourceAreas', '_apis/{resource}/{areaId}'),
+    ('603fe2ac-9723-48b9-88ad-09305aa6c6e1', 'core', 'projects', '_apis/{resource}/{*projectId}'),
+    ('225f7195-f9c7-4d14-ab28-a83f7ff77e1f', 'git', 'repositories', '{project}/_apis/{area}/{resource}/{repositoryId}'),
+    ('2d874a60-a811-4f62-9c9f-963a6ea0a55b', 'git', 'refs', '{project}/_apis/{area}/repositories/{repositoryId}/{resource}/{*filter}'),
+    ('fb93c0db-47ed-4a31-8c20-47552878fb44', 'git', 'items', '{project}/_apis/{area}/repositories/{repositoryId}/{resource}/{*path}'),
+    ('ea98d07b-3c87-4971-8ede-a613694ffb55', 'git', 'pushes', '{project}/_apis/{area}/repositories/{repositoryId}/{resource}/{pushId}'),
+    ('dbeaf647-6167-421a-bda9-c9327b25e2e6', 'build', 'definitions', '{project}/_apis/{area}/{resource}/{definitionId}'),
+    ('d8f96f24-8ea7-4cb6-baab-2df8fc515665', 'Release', 'definitions', '{project}/_apis/{area}/{resource}/{definitionId}'),
+    ('a8c47e17-4d56-4a56-92bb-de7ea7dc65be', 'distributedtask', 'pools', '_apis/{area}/{resource}/{poolId}'),
+    ('900fa995-c559-4923-aae7-f8424fe4fbea', 'distributedtask', 'queues', '{project}/_apis/{area}/{resource}/{queueId}'),
+]
+
+class NotFound(Exception):
+    pass
+
+class Conflict(Exception):
+    def __init__(self, message, status=409):
+        super().__init__(message)
+        self.status = status
+
+class FakeAdoState:
+    def __init__(self, organisation_name='bench-org', project_names=('bench-project',), build_definitions=0, release_definitions=0,
+                 stages_per_release=3, repositories=0, users=100):
+        self.organisation_name = organisation_name
+        self.lock = threading.Lock()
+        self.projects = {}
+        self.repositories = {}
+        self.build_definitions = {}
+        self.release_definitions = {}
+        self.queues = {}
+        self.users = []
+        self.next_id = 1
+        self.pool = {'id': 9, 'name': DEFAULT_POOL_NAME, 'isHosted': True, 'isLegacy': False, 'poolType': 'automation', 'scope': str(uuid.uuid4()), 'size': 1}
+        for name in project_names:
+            project_id = str(uuid.uuid4())
+            self.projects[project_id] = {'id': project_id, 'name': name, 'state': 'wellFormed', 'revision': 1, 'visibility': 'private',
+                                         'lastUpdateTime': '2021-01-01T00:00:00Z'}
+            self.queues[project_id] = [{'id': 1, 'name': DEFAULT_POOL_NAME, 'pool': dict(self.pool), 'projectId': project_id}]
+            self.repositories[project_id] = {}
+            self.build_definitions[project_id] = {}
+            self.release_definitions[project_id] = {}
+            for index in range(repositories):
+                self.addRepository(project_id, 'seed-repo-' + str(index))
+            for index in range(build_definitions):
+                self.addBuildDefinition(project_id, 'seed-build-' + str(index))
+            for index in range(release_definitions):
+                environments = [{'id': self.newId(), 'name': 'stage-' + str(rank), 'rank': rank, 'conditions': []} for rank in range(1, stages_per_release + 1)]
+                self.addReleaseDefinition(project_id, {'name': 'seed-release-' + str(index), 'environments': environments})
+        for index in range(users):
+            self.users.append({'principalName': 'user' + str(index) + '@example.com', 'displayName': 'User ' + str(index),
+                               'descriptor': 'aad.' + uuid.uuid4().hex, 'entitlementId': str(uuid.uuid4())})
+        self.users_by_descriptor = {user['descriptor']: user for user in self.users}
+
+    def newId(self):
+        self.next_id = self.next_id + 1
+        return self.next_id
+
+    def project(self, reference):
+        reference = unquote(reference)
+        for project in self.projects.values():
+            if project['id'] == reference or project['name'].lower() == reference.lower():
+                return project
+        raise NotFound("Project " + reference + " does not exist")
+
+    def repository(self, project, reference):
+        reference = unquote(reference)
+        for repository in self.repositories[project['id']].values():
+            if repository['id'] == reference or repository['name'].lower() == reference.lower():
+                return repository
+        raise NotFound("Repository " + reference + " does not exist")
+
+    def addRepository(self, project_id, name):
+        repository_id = str(uuid.uuid4())
+        project = self.projects[project_id]
+        self.repositories[project_id][repository_id] = {
+            'id': repository_id, 'name': name, 'url': 'https://dev.azure.com/' + self.organisation_name + '/_apis/git/repositories/' + repository_id,
+            'webUrl': 'https://dev.azure.com/' + self.organisation_name + '/' + project['name'] + '/_git/' + name,
+            'project': {'id': project_id, 'name': project['name']}, 'isFork': False, 'size': 0,
+            'refs': {}, 'files': {}
+        }
+        return self.repositories[project_id][repository_id]
+
+    def addBuildDefinition(self, project_id, name):
+        definition_id = self.newId()
+        self.build_definitions[project_id][definition_id] = {'id': definition_id, 'name': name, 'path': '\\', 'revision': 1, 'type': 'build', 'queueStatus': 'enabled'}
+        return self.build_definitions[project_id][definition_id]
+
+    def addReleaseDefinition(self, project_id, definition):
+        used = set(environment['id'] for existing in self.release_definitions[project_id].values() for environment in existing['environments'])
+        for environment in definition.get('environments') or []:
+            if environment.get('id') in used:
+                raise Conflict("Environment id " + str(environment['id']) + " is already used in this project", status=400)
+        definition = dict(definition)
+        definition['id'] = self.newId()
+        definition['revision'] = 1
+        definition['environments'] = definition.get('environments') or []
+        self.release_definitions[project_id][definition['id']] = definition
+        return definition
+
+def userView(user):
+    return {'principalName': user['principalName'], 'displayName': user['displayName'], 'descriptor': user['descriptor'],
+            'subjectKind': 'user', 'url': 'https://vssps.dev.azure.com/_apis/Graph/Users/' + user['descriptor']}
+
+def buildView(definition):
+    return {key: value for key, value in definition.items()}
+
+def releaseView(definition, expand):
+    view = {key: value for key, value in definition.items() if key != 'environments'}
+    if expand:
+        view['environments'] = definition['environments']
+    return view
+
+class FakeAdoServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), state=None, latency=0.0, throttle_every=0, retry_after=0, page_size=100, users_page_size=500, etags=False):
+        self.state = state or FakeAdoState()
+        self.etags = etags
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.users_page_size = users_page_size
+        self.stats_lock = threading.Lock()
+        self.resetStats()
+        self.routes = self.buildRoutes()
+        self.thread = None
+        super().__init__(address, FakeAdoHandler)
+
+    @property
+    def url(self):
+        return 'http://' + self.server_address[0] + ':' + str(self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def resetStats(self):
+        with self.stats_lock:
+            self.stats = {'requests': 0, 'throttled': 0, 'bytes_sent': 0, 'routes': {}}
+
+    def record(self, route, status, size):
+        with self.stats_lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_sent'] += size
+            if status == 429:
+                self.stats['throttled'] += 1
+            self.stats['routes'][route] = self.stats['routes'].get(route, 0) + 1
+            return self.stats['requests']
+
+    def snapshot(self):
+        with self.stats_lock:
+            return json.loads(json.dumps(self.stats))
+
+    def buildRoutes(self):
+        project = r'/(?P<org>[^/]+)/(?P<project>[^/_][^/]*)/_apis'
+        organisation = r'/(?P<org>[^/]+)/_apis'
+        routes = [
+            ('_fake', 'GET', r'/stats', self.getStats, '_fake/stats'),
+            ('_fake', 'POST', r'/reset', self.postReset, '_fake/reset'),
+            ('*', 'OPTIONS', organisation + r'/?', self.options, '_apis'),
+            ('dev.azure.com', 'GET', organisation + r'/ResourceAreas/?', self.resourceAreas, '_apis/ResourceAreas'),
+            ('dev.azure.com', 'GET', organisation + r'/projects/(?P<project>[^/]+)', self.getProject, '_apis/projects/{projectId}'),
+            ('dev.azure.com', 'GET', project + r'/git/repositories/?', self.getRepositories, '{project}/_apis/git/repositories'),
+            ('dev.azure.com', 'POST', project + r'/git/repositories/?', self.createRepository, '{project}/_apis/git/repositories'),
+            ('dev.azure.com', 'GET', project + r'/git/repositories/(?P<repository>[^/]+)/refs.*', self.getRefs, '{project}/_apis/git/repositories/{repositoryId}/refs'),
+            ('dev.azure.com', 'GET', project + r'/git/repositories/(?P<repository>[^/]+)/items.*', self.getItems, '{project}/_apis/git/repositories/{repositoryId}/items'),
+            ('dev.azure.com', 'POST', project + r'/git/repositories/(?P<repository>[^/]+)/pushes/?', self.createPush, '{project}/_apis/git/repositories/{repositoryId}/pushes'),
+            ('dev.azure.com', 'GET', project + r'/git/repositories/(?P<repository>[^/]+)/?', self.getRepository, '{project}/_apis/git/repositories/{repositoryId}'),
+            ('dev.azure.com', 'DELETE', project + r'/git/repositories/(?P<repository>[^/]+)/?', self.deleteRepository, '{project}/_apis/git/repositories/{repositoryId}'),
+            ('dev.azure.com', 'GET', project + r'/build/definitions/?', self.getBuildDefinitions, '{project}/_apis/build/definitions'),
+            ('dev.azure.com', 'DELETE', project + r'/build/definitions/(?P<definition>\d+)/?', self.deleteBuildDefinition, '{project}/_apis/build/definitions/{definitionId}'),
+            ('dev.azure.com', 'POST', project + r'/pipelines/?', self.createPipeline, '{project}/_apis/pipelines'),
+            ('dev.azure.com', 'GET', organisation + r'/distributedtask/pools/?', self.getPools, '_apis/distributedtask/pools'),
+            ('dev.azure.com', 'GET', project + r'/distributedtask/queues/?', self.getQueues, '{project}/_apis/distributedtask/queues'),
+            ('dev.azure.com', 'POST', project + r'/distributedtask/queues/?', self.addQueue, '{project}/_apis/distributedtask/queues'),
+            ('vsrm.dev.azure.com', 'GET', project + r'/release/definitions/?', self.getReleaseDefinitions, '{project}/_apis/release/definitions'),
+            ('vsrm.dev.azure.com', 'POST', project + r'/release/definitions/?', self.createReleaseDefinition, '{project}/_apis/release/definitions'),
+            ('vsrm.dev.azure.com', 'PUT', project + r'/release/definitions/?', self.updateReleaseDefinition, '{project}/_apis/release/definitions'),
+            ('vsrm.dev.azure.com', 'GET', project + r'/release/definitions/(?P<definition>\d+)/?', self.getReleaseDefinition, '{project}/_apis/release/definitions/{definitionId}'),
+            ('vsrm.dev.azure.com', 'DELETE', project + r'/release/definitions/(?P<definition>\d+)/?', self.deleteReleaseDefinition, '{project}/_apis/release/definitions/{definitionId}'),
+            ('vssps.dev.azure.com', 'GET', organisation + r'/graph/users/?', self.getUsers, '_apis/graph/users'),
+            ('vsaex.dev.azure.com', 'GET', organisation + r'/userentitlements/(?P<descriptor>[^/]+)', self.getEntitlement, '_apis/userentitlements/{descriptor}'),
+        ]
+        return [(host, method, re.compile(pattern + '$', re.IGNORECASE), handler, template) for host, method, pattern, handler, template in routes]
+
+    def dispatch(self, method, host, path):
+        for route_host, route_method, pattern, handler, template in self.routes:
+            if route_method != method or (route_host != '*' and route_host != host):
+                continue
+            match = pattern.match(path)
+            if match:
+                return handler, match.groupdict(), method + ' ' + host + '/' + template
+        return None, {}, method + ' ' + host + '/<unknown>'
+
+    def page(self, items, query, top_parameter, token_parameter, page_size):
+        start = int(query.get(token_parameter, ['0'])[0] or 0)
+        size = min(int(query.get(top_parameter, [page_size])[0]), page_size)
+        chunk = items[start:start + size]
+        headers = {}
+        if start + size < len(items):
+            headers['x-ms-continuationtoken'] = str(start + size)
+        return chunk, headers
+
+    def collection(self, items, headers=None):
+        return 200, {'count': len(items), 'value': items}, headers or {}
+
+    def getStats(self, query, body, **route):
+        return 200, self.snapshot(), {}
+
+    def postReset(self, query, body, **route):
+        self.resetStats()
+        return 200, {}, {}
+
+    def options(self, query, body, **route):
+        locations = [{'id': location_id, 'area': area, 'resourceName': resource, 'routeTemplate': template, 'resourceVersion': 1,
+                      'minVersion': '1.0', 'maxVersion': '7.0', 'releasedVersion': '6.0'}
+                     for location_id, area, resource, template in LOCATIONS]
+        return self.collection(locations)
+
+    def resourceAreas(self, query, body, org):
+        areas = [{'id': area_id, 'name': name, 'locationUrl': 'https://' + host + '/' + org + '/'} for area_id, (name, host) in RESOURCE_AREAS.items()]
+        return self.collection(areas)
+
+    def getProject(self, query, body, org, project):
+        return 200, self.state.project(project), {}
+
+    def repositoryView(self, repository):
+        view = {key: value for key, value in repository.items() if key not in ('refs', 'files')}
+        if repository['refs']:
+            view['defaultBranch'] = 'refs/heads/master' if 'refs/heads/master' in repository['refs'] else sorted(repository['refs'])[0]
+        return view
+
+    def getRepositories(self, query, body, org, project):
+        project = self.state.project(project)
+        return self.collection([self.repositoryView(repository) for repository in self.state.repositories[project['id']].values()])
+
+    def createRepository(self, query, body, org, project):
+        project = self.state.project(project)
+        with self.state.lock:
+            if any(repository['name'].lower() == body['name'].lower() for repository in self.state.repositories[project['id']].values()):
+                raise Conflict("Repository " + body['name'] + " already exists")
+            repository = self.state.addRepository(project['id'], body['name'])
+        return 201, self.repositoryView(repository), {}
+
+    def getRepository(self, query, body, org, project, repository):
+        project = self.state.project(project)
+        return 200, self.repositoryView(self.state.repository(project, repository)), {}
+
+    def deleteRepository(self, query, body, org, project, repository):
+        project = self.state.project(project)
+        with self.state.lock:
+            repository = self.state.repository(project, repository)
+            del self.state.repositories[project['id']][repository['id']]
+        return 204, None, {}
+
+    def getRefs(self, query, body, org, project, repository):
+        repository = self.state.repository(self.state.project(project), repository)
+        prefix = 'refs/' + query.get('filter', [''])[0]
+        refs = [{'name': name, 'objectId': object_id} for name, object_id in sorted(repository['refs'].items()) if name.startswith(prefix)]
+        return self.collection(refs)
+
+    def getItems(self, query, body, org, project, repository):
+        repository = self.state.repository(self.state.project(project), repository)
+        if query.get('recursionLevel', ['none'])[0].lower() == 'full':
+            return self.collection([{'path': path, 'gitObjectType': 'blob', 'objectId': object_id} for path, (object_id, _) in sorted(repository['files'].items())])
+        path = query.get('path', [''])[0]
+        if path not in repository['files']:
+            raise NotFound("TF401174: The item '" + path + "' could not be found in the repository")
+        object_id, content = repository['files'][path]
+        item = {'path': path, 'gitObjectType': 'blob', 'objectId': object_id}
+        if query.get('includeContent', ['false'])[0].lower() == 'true':
+            item['content'] = content
+        return 200, item, {}
+
+    def createPush(self, query, body, org, project, repository):
+        repository = self.state.repository(self.state.project(project), repository)
+        with self.state.lock:
+            ref_update = body['refUpdates'][0]
+            current = repository['refs'].get(ref_update['name'], '0' * 40)
+            if ref_update['oldObjectId'] != current:
+                raise Conflict("TF401028: The reference '" + ref_update['name'] + "' has already been updated by another client")
+            for commit in body['commits']:
+                for change in commit['changes']:
+                    path = change['item']['path']
+                    if change['changeType'] == 'add' and path in repository['files']:
+                        raise Conflict("TF160006: The item " + path + " already exists", status=400)
+                    if change['changeType'] == 'edit' and path not in repository['files']:
+                        raise NotFound("TF401174: The item '" + path + "' could not be found")
+                    repository['files'][path] = (uuid.uuid4().hex + uuid.uuid4().hex[:8], change['newContent']['content'])
+            commit_id = uuid.uuid4().hex + uuid.uuid4().hex[:8]
+            repository['refs'][ref_update['name']] = commit_id
+        return 201, {'pushId': self.state.newId(), 'commits': [{'commitId': commit_id}], 'refUpdates': [{'name': ref_update['name'], 'newObjectId': commit_id}]}, {}
+
+    def getBuildDefinitions(self, query, body, org, project):
+        project = self.state.project(project)
+        name = query.get('name', [None])[0]
+        definitions = sorted(self.state.build_definitions[project['id']].values(), key=lambda definition: definition['name'].lower())
+        if name:
+            definitions = [definition for definition in definitions if fnmatch.fnmatch(definition['name'].lower(), name.lower())]
+        page, headers = self.page(definitions, query, '$top', 'continuationToken', self.page_size)
+        return self.collection([buildView(definition) for definition in page], headers)
+
+    def deleteBuildDefinition(self, query, body, org, project, definition):
+        project = self.state.project(project)
+        with self.state.lock:
+            if self.state.build_definitions[project['id']].pop(int(definition), None) is None:
+                raise NotFound("Build definition " + definition + " does not exist")
+        return 204, None, {}
+
+    def createPipeline(self, query, body, org, project):
+        project = self.state.project(project)
+        with self.state.lock:
+            repository_id = body['configuration']['repository']['id']
+            if repository_id not in self.state.repositories[project['id']]:
+                raise NotFound("Repository " + str(repository_id) + " does not exist")
+            definition = self.state.addBuildDefinition(project['id'], body['name'])
+        return 200, {'id': definition['id'], 'name': definition['name'], 'revision': 1}, {}
+
+    def getPools(self, query, body, org):
+        name = query.get('poolName', [None])[0]
+        pools = [self.state.pool] if name is None or name == self.state.pool['name'] else []
+        return self.collection(pools)
+
+    def getQueues(self, query, body, org, project):
+        project = self.state.project(project)
+        return self.collection(self.state.queues[project['id']])
+
+    def addQueue(self, query, body, org, project):
+        project = self.state.project(project)
+        with self.state.lock:
+            queue = dict(body, id=len(self.state.queues[project['id']]) + 1, projectId=project['id'])
+            self.state.queues[project['id']].append(queue)
+        return 200, queue, {}
+
+    def getReleaseDefinitions(self, query, body, org, project):
+        project = self.state.project(project)
+        search_text = (query.get('searchText', [''])[0] or '').lower()
+        exact = query.get('isExactNameMatch', ['false'])[0].lower() == 'true'
+        expand = 'environments' in query.get('$expand', [''])[0].lower()
+        definitions = sorted(self.state.release_definitions[project['id']].values(), key=lambda definition: definition['name'].lower())
+        if search_text:
+            if exact:
+                definitions = [definition for definition in definitions if definition['name'].lower() == search_text]
+            else:
+                definitions = [definition for definition in definitions if search_text in definition['name'].lower()]
+        page, headers = self.page(definitions, query, '$top', 'continuationToken', self.page_size)
+        return self.collection([releaseView(definition, expand) for definition in page], headers)
+
+    def getReleaseDefinition(self, query, body, org, project, definition):
+        project = self.state.project(project)
+        found = self.state.release_definitions[project['id']].get(int(definition))
+        if found is None:
+            raise NotFound("Release definition " + definition + " does not exist")
+        return 200, found, {}
+
+    def createReleaseDefinition(self, query, body, org, project):
+        project = self.state.project(project)
+        with self.state.lock:
+            if any(definition['name'].lower() == body['name'].lower() for definition in self.state.release_definitions[project['id']].values()):
+                raise Conflict("Release definition " + body['name'] + " already exists", status=400)
+            definition = self.state.addReleaseDefinition(project['id'], body)
+        return 200, definition, {}
+
+    def updateReleaseDefinition(self, query, body, org, project):
+        project = self.state.project(project)
+        with self.state.lock:
+            existing = self.state.release_definitions[project['id']].get(body.get('id'))
+            if existing is None:
+                raise NotFound("Release definition " + str(body.get('id')) + " does not exist")
+            if body.get('revision') != existing['revision']:
+                raise Conflict("VS402898: Release definition " + existing['name'] + " has been modified by someone else")
+            definition = dict(body, revision=existing['revision'] + 1)
+            self.state.release_definitions[project['id']][definition['id']] = definition
+        return 200, definition, {}
+
+    def deleteReleaseDefinition(self, query, body, org, project, definition):
+        project = self.state.project(project)
+        with self.state.lock:
+            if self.state.release_definitions[project['id']].pop(int(definition), None) is None:
+                raise NotFound("Release definition " + definition + " does not exist")
+        return 204, None, {}
+
+    def getUsers(self, query, body, org):
+        start = int(query.get('continuationToken', ['0'])[0] or 0)
+        users = self.state.users[start:start + self.users_page_size]
+        headers = {}
+        if start + self.users_page_size < len(self.state.users):
+            headers['X-MS-ContinuationToken'] = str(start + self.users_page_size)
+        return self.collection([userView(user) for user in users], headers)
+
+    def getEntitlement(self, query, body, org, descriptor):
+        user = self.state.users_by_descriptor.get(descriptor)
+        if user is None:
+            raise NotFound("User " + descriptor + " does not exist")
+        return 200, {'id': user['entitlementId'], 'user': userView(user), 'accessLevel': {'accountLicenseType': 'express'}}, {}
+
+class FakeAdoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_method('GET')
+
+    def do_POST(self):
+        self.handle_method('POST')
+
+    def do_PUT(self):
+        self.handle_method('PUT')
+
+    def do_DELETE(self):
+        self.handle_method('DELETE')
+
+    def do_OPTIONS(self):
+        self.handle_method('OPTIONS')
+
+    def handle_method(self, method):
+        server = self.server
+        parts = urlsplit(self.path)
+        host, _, path = parts.path.lstrip('/').partition('/')
+        query = parse_qs(parts.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else b''
+        handler, route, template = server.dispatch(method, host, '/' + path)
+
+        if server.latency and host != '_fake':
+            time.sleep(server.latency)
+        if server.throttle_every and host != '_fake' and (server.stats['requests'] + 1) % server.throttle_every == 0:
+            self.reply(template, 429, {'message': 'TF400733: The request has been throttled'}, {'Retry-After': str(server.retry_after)})
+            return
+        if handler is None:
+            self.reply(template, 404, {'message': 'No fake route for ' + method + ' ' + self.path, 'typeKey': 'NotFoundException'})
+            return
+        try:
+            body = json.loads(raw_body) if raw_body else None
+            status, payload, headers = handler(query, body, **route)
+        except NotFound as error:
+            status, payload, headers = 404, {'message': str(error), 'typeKey': 'NotFoundException', 'errorCode': 0, 'eventId': 3000}, {}
+        except Conflict as error:
+            status, payload, headers = error.status, {'message': str(error), 'typeKey': 'InvalidRequestException', 'errorCode': 0, 'eventId': 3000}, {}
+        self.reply(template, status, payload, headers)
+
+    def reply(self, template, status, payload, headers=None):
+        data = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        if self.server.etags and self.command == 'GET' and status == 200:
+            etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+            headers = dict(headers or {}, ETag=etag)
+            if self.headers.get('If-None-Match') == etag:
+                status, data = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        if not template.startswith(('GET _fake', 'POST _fake')):
+            self.server.record(template, status, len(data))
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves a local stand-in for the Azure DevOps APIs used by project_setup.py. '
+                                                 'Point the tool at it with PROJECT_SETUP_ADO_ENDPOINT=http://HOST:PORT')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8089, type=int)
+    parser.add_argument('--organisation_name', default='bench-org', type=str)
+    parser.add_argument('--azure_project_name', default=['bench-project'], nargs='+')
+    parser.add_argument('--build_definitions', help='Build definitions seeded into every project', default=0, type=int)
+    parser.add_argument('--release_definitions', help='Release definitions seeded into every project', default=0, type=int)
+    parser.add_argument('--repositories', help='Repositories seeded into every project', default=0, type=int)
+    parser.add_argument('--users', help='Users in the organisation, named user<N>@example.com', default=100, type=int)
+    parser.add_argument('--latency', help='Seconds added to every response', default=0.0, type=float)
+    parser.add_argument('--throttle_every', help='Answer every Nth request with 429', default=0, type=int)
+    parser.add_argument('--retry_after', help='The Retry-After seconds sent with a 429', default=0, type=int)
+    parser.add_argument('--page_size', help='Definitions returned per page', default=100, type=int)
+    parser.add_argument('--etags', help='Send ETags and answer a matching If-None-Match with 304', action='store_true')
+    args = parser.parse_args()
+
+    state = FakeAdoState(args.organisation_name, args.azure_project_name, build_definitions=args.build_definitions,
+                         release_definitions=args.release_definitions, repositories=args.repositories, users=args.users)
+    server = FakeAdoServer((args.host, args.port), state, latency=args.latency, throttle_every=args.throttle_every,
+                           retry_after=args.retry_after, page_size=args.page_size, etags=args.etags)
+    print("Serving organisation " + args.organisation_name + " at " + server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
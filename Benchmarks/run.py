@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+# Every run starts its own fake server and runs project_setup.py as a separate process, so SDK caches start cold
+# and the peak memory reported is the CLI's own
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ORGANISATION_NAME = 'bench-org'
+AZURE_PROJECT_NAME = 'bench-project'
+SCENARIOS = ['create', 'delete', 'batch', 'apply', 'teardown']
+PRESETS = {
+    'small': {'build_definitions': 100, 'release_definitions': 100, 'users': 1000, 'projects': 5},
+    'large': {'build_definitions': 10000, 'release_definitions': 10000, 'users': 50000, 'projects': 20},
+}
+TEMPLATE = "trigger:\n- {{ branch }}\npool:\n  {{ pool }}\nstages: {{ environment_names }}\n"
+
+class FakeServerProcess:
+    def __init__(self, args):
+        command = [sys.executable, '-m', 'Benchmarks.fake_ado', '--port', '0', '--organisation_name', ORGANISATION_NAME,
+                   '--azure_project_name', AZURE_PROJECT_NAME, '--build_definitions', str(args.build_definitions),
+                   '--release_definitions', str(args.release_definitions), '--users', str(args.users),
+                   '--latency', str(args.latency), '--throttle_every', str(args.throttle_every), '--page_size', str(args.page_size)]
+        if args.etags:
+            command.append('--etags')
+        self.process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError("The fake Azure DevOps server did not start")
+        self.url = line.strip().split(' at ')[-1]
+
+    def stats(self):
+        return requests.get(self.url + '/_fake/stats', timeout=10).json()
+
+    def reset(self):
+        requests.post(self.url + '/_fake/reset', timeout=10)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+class Workspace:
+    def __init__(self, args):
+        self.directory = tempfile.mkdtemp(prefix='project_setup_bench_')
+        with open(os.path.join(self.directory, 'bench.yml'), 'w') as template_file:
+            template_file.write(TEMPLATE)
+        self.languages_file = os.path.join(self.directory, 'languages.json')
+        with open(self.languages_file, 'w') as languages_file:
+            json.dump({'languages': {'bench': {'path': 'bench.yml'}}}, languages_file)
+        self.manifest = os.path.join(self.directory, 'manifest.json')
+        with open(self.manifest, 'w') as manifest_file:
+            json.dump({
+                'organisation_name': ORGANISATION_NAME,
+                'azure_project_name': AZURE_PROJECT_NAME,
+                # The last user is the slowest to find in the graph
+                'user_email': 'user' + str(args.users - 1) + '@example.com',
+                'environment_names': ['dev', 'qa', 'prod'],
+                'language': 'bench',
+                'projects': ['bench-app-' + str(index) for index in range(args.projects)]
+            }, manifest_file)
+        self.user_email = 'user' + str(args.users - 1) + '@example.com'
+        self.engine = args.engine
+        self.warm = args.warm
+
+    def command(self, name):
+        common = ['--personal_access_token', 'bench-token']
+        manifest = ['--manifest', self.manifest, '--languages_file', self.languages_file] + common
+        if name == 'create':
+            return ['create', '--project_name', 'bench-app', '--organisation_name', ORGANISATION_NAME, '--azure_project_name', AZURE_PROJECT_NAME,
+                    '--user_email', self.user_email, '--environment_names', 'dev', 'qa', 'prod', '--language', 'bench',
+                    '--languages_file', self.languages_file] + common
+        if name == 'delete':
+            return ['delete', '--project_name', 'bench-app', '--organisation_name', ORGANISATION_NAME, '--azure_project_name', AZURE_PROJECT_NAME] + common
+        engine = ['--engine', self.engine]
+        if name == 'teardown':
+            return ['teardown', '--manifest', self.manifest, '--yes'] + engine + common
+        return [name] + manifest + engine
+
+# What has to exist before a scenario is measured
+SETUP = {'create': [], 'delete': ['create'], 'batch': [], 'apply': ['batch'], 'teardown': ['batch']}
+
+def cliEnvironment(server, workspace):
+    # Unless --warm is given, every run starts without the metadata cache the previous one left
+    metadata_cache = os.path.join(workspace.directory, 'metadata.json' if workspace.warm else 'metadata_' + str(time.monotonic_ns()) + '.json')
+    return dict(os.environ, PROJECT_SETUP_ADO_ENDPOINT=server.url, PROJECT_SETUP_METADATA_CACHE=metadata_cache,
+                AZURE_DEVOPS_CACHE_DIR=os.path.join(workspace.directory, 'sdk_cache_' + str(time.monotonic_ns())))
+
+def runCli(arguments, server, workspace, stdin=''):
+    environment = cliEnvironment(server, workspace)
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'project_setup.py')] + arguments, cwd=workspace.directory, env=environment,
+                               stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    process.stdin.write(stdin)
+    process.stdin.close()
+    error_output = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - started
+    if process.returncode != 0:
+        raise RuntimeError(" ".join(arguments[:1]) + " exited with " + str(process.returncode) + ":\n" + error_output[-2000:])
+    # ru_maxrss is reported in kilobytes on Linux
+    return elapsed, usage.ru_maxrss / 1024.0
+
+def runScenario(name, args):
+    workspace = Workspace(args)
+    server = FakeServerProcess(args)
+    try:
+        for step in SETUP[name]:
+            runCli(workspace.command(step), server, workspace)
+        server.reset()
+        elapsed, peak_memory = runCli(workspace.command(name), server, workspace, stdin='bench-app\n')
+        stats = server.stats()
+    finally:
+        server.stop()
+    writes = sum(count for route, count in stats['routes'].items() if route.split(' ')[0] in ('POST', 'PUT', 'DELETE'))
+    return {'scenario': name, 'wall_time': elapsed, 'requests': stats['requests'], 'writes': writes, 'throttled': stats['throttled'],
+            'kilobytes_received': stats['bytes_sent'] / 1024.0, 'peak_memory_mb': peak_memory, 'routes': stats['routes']}
+
+def printResults(results, show_routes):
+    print("")
+    print("Scenario   Time      Requests  Writes  Throttled  Received KB  Peak MB")
+    for result in results:
+        print(result['scenario'].ljust(9) + "  " + (format(result['wall_time'], '.2f') + "s").ljust(8) + "  " + str(result['requests']).ljust(8) + "  "
+              + str(result['writes']).ljust(6) + "  " + str(result['throttled']).ljust(9) + "  " + format(result['kilobytes_received'], '.0f').ljust(11)
+              + "  " + format(result['peak_memory_mb'], '.1f'))
+        if show_routes:
+            for route, count in sorted(result['routes'].items(), key=lambda item: -item[1]):
+                print("    " + str(count).rjust(6) + "  " + route)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures project_setup.py against a local fake Azure DevOps server')
+    parser.add_argument('--scenarios', default=SCENARIOS, nargs='+', choices=SCENARIOS)
+    parser.add_argument('--preset', default='small', choices=sorted(PRESETS), help='Data volume to seed (default: %(default)s)')
+    parser.add_argument('--build_definitions', type=int, help='Build definitions already in the project')
+    parser.add_argument('--release_definitions', type=int, help='Release definitions already in the project')
+    parser.add_argument('--users', type=int, help='Users in the organisation')
+    parser.add_argument('--projects', type=int, help='Projects in the batch manifest')
+    parser.add_argument('--latency', default=0.0, type=float, help='Seconds the server waits before every response')
+    parser.add_argument('--throttle_every', default=0, type=int, help='Answer every Nth request with 429')
+    parser.add_argument('--page_size', default=100, type=int, help='Definitions returned per page')
+    parser.add_argument('--engine', default='threads', choices=['threads', 'async'], help='The engine batch, apply and teardown run with (default: %(default)s)')
+    parser.add_argument('--etags', action='store_true', help='Have the fake server send ETags and answer If-None-Match with 304')
+    parser.add_argument('--warm', action='store_true', help='Keep the metadata cache from the setup runs, as repeated runs would')
+    parser.add_argument('--routes', action='store_true', help='Show the requests made per route')
+    parser.add_argument('--output', type=str, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+    for name, value in PRESETS[args.preset].items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+
+    results = []
+    for name in args.scenarios:
+        print("Running " + name + "...", flush=True)
+        results.append(runScenario(name, args))
+    printResults(results, args.routes)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'settings': vars(args), 'results': results}, output_file, indent=2)
+
+if __name__ == "__main__":
+    main()
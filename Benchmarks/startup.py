@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from .run import ROOT, PRESETS, FakeServerProcess, Workspace, runCli, cliEnvironment
+
+SCENARIOS = ['help', 'usage-error', 'delete']
+HEAVY_MODULES = ['azure.devops', 'msrest', 'requests', 'git', 'aiohttp', 'yaml']
+# What each scenario must never import: --help and argument errors stop before any command runs, and delete has no use for
+# GitPython, aiohttp or a YAML manifest
+FORBIDDEN = {'help': HEAVY_MODULES, 'usage-error': HEAVY_MODULES, 'delete': ['git', 'aiohttp', 'yaml']}
+EXIT_CODES = {'help': 0, 'usage-error': 2, 'delete': 0}
+
+def parseImportTimes(error_output):
+    # -X importtime writes "import time: self [us] | cumulative | name", nested imports indented below the one that loaded them
+    imports = {}
+    total = 0
+    for line in error_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+        imports[name.strip()] = int(cumulative)
+    return imports, total / 1e6
+
+def loadedHeavyModules(imports):
+    return [module for module in HEAVY_MODULES if any(name == module or name.startswith(module + '.') for name in imports)]
+
+class Scenario:
+    def __init__(self, name, args):
+        self.name = name
+        self.server = None
+        self.workspace = None
+        if name == 'delete':
+            self.workspace = Workspace(args)
+            self.server = FakeServerProcess(args)
+
+    def arguments(self):
+        if self.name == 'help':
+            return ['--help']
+        if self.name == 'usage-error':
+            return ['create', '--project_name', 'bench-app']
+        # Every delete needs something to delete; creating it is not measured
+        runCli(self.workspace.command('create'), self.server, self.workspace)
+        return self.workspace.command('delete')
+
+    def runOnce(self, import_time=False):
+        arguments = self.arguments()
+        environment = cliEnvironment(self.server, self.workspace) if self.server else dict(os.environ)
+        command = [sys.executable] + (['-X', 'importtime'] if import_time else []) + [os.path.join(ROOT, 'project_setup.py')] + arguments
+        started = time.perf_counter()
+        process = subprocess.run(command, cwd=self.workspace.directory if self.workspace else ROOT, env=environment, input='bench-app\n',
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        elapsed = time.perf_counter() - started
+        if process.returncode != EXIT_CODES[self.name]:
+            raise RuntimeError(self.name + " exited with " + str(process.returncode) + ":\n" + process.stderr[-2000:])
+        return elapsed, process.stderr
+
+    def stop(self):
+        if self.server:
+            self.server.stop()
+
+def runScenario(name, args):
+    scenario = Scenario(name, args)
+    try:
+        # -X importtime slows the run it measures, so wall times come from separate runs
+        times = [scenario.runOnce()[0] for _ in range(args.repeat)]
+        imports, import_time = parseImportTimes(scenario.runOnce(import_time=True)[1])
+    finally:
+        scenario.stop()
+    heavy = loadedHeavyModules(imports)
+    return {'scenario': name, 'mean': statistics.mean(times), 'min': min(times), 'import_time': import_time, 'heavy_modules': heavy,
+            'forbidden_modules': [module for module in heavy if module in FORBIDDEN[name]],
+            'slowest_imports': sorted(imports.items(), key=lambda item: -item[1])[:args.slowest]}
+
+def printResults(results):
+    print("")
+    print("Scenario     Mean s   Min s    Imports s  Heavy modules loaded")
+    for result in results:
+        print(result['scenario'].ljust(11) + "  " + format(result['mean'], '.3f').ljust(7) + "  " + format(result['min'], '.3f').ljust(7) + "  "
+              + format(result['import_time'], '.3f').ljust(9) + "  " + (", ".join(result['heavy_modules']) or "-"))
+        for name, cumulative in result['slowest_imports']:
+            print("    " + format(cumulative / 1000.0, '.1f').rjust(7) + " ms  " + name)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures how long project_setup.py takes to start and which heavy modules each command loads')
+    parser.add_argument('--scenarios', default=SCENARIOS, nargs='+', choices=SCENARIOS)
+    parser.add_argument('--repeat', default=5, type=int, help='Runs timed per scenario (default: %(default)s)')
+    parser.add_argument('--slowest', default=0, type=int, help='Also show this many of the slowest imports per scenario')
+    parser.add_argument('--budget', type=float, help='Fail if --help or an argument error takes longer than this many seconds on average')
+    parser.add_argument('--output', type=str, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+    # Workspace and FakeServerProcess read the data volume from the same settings as Benchmarks/run.py
+    args.__dict__.update(PRESETS['small'], latency=0.0, throttle_every=0, page_size=100, engine='threads', etags=False, warm=False)
+
+    results = []
+    for name in args.scenarios:
+        print("Running " + name + "...", flush=True)
+        results.append(runScenario(name, args))
+    printResults(results)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'settings': vars(args), 'results': results}, output_file, indent=2)
+
+    failures = []
+    for result in results:
+        if result['forbidden_modules']:
+            failures.append(result['scenario'] + " loaded " + ", ".join(result['forbidden_modules']))
+        if args.budget is not None and result['scenario'] != 'delete' and result['mean'] > args.budget:
+            failures.append(result['scenario'] + " took " + format(result['mean'], '.3f') + "s, over the " + format(args.budget, '.3f') + "s budget")
+    if failures:
+        sys.exit("\n".join(failures))
+
+if __name__ == "__main__":
+    main()
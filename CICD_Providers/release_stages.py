@@ -0,0 +1,210 @@
+from collections import deque
+
+APPROVER_ID = "aeb95c63-4fac-4948-84ce-711b0a9dda97"
+SUCCEEDED_STATE = "4"
+STAGE_CONDITION_TYPES = ('environmentState', 'event')
+
+def stageLayout(environments):
+    # The part of a definition the stage graph decides: stage names in rank order and what each waits for
+    layout = []
+    for environment in sorted(environments, key=lambda environment: environment.get('rank') or 0):
+        predecessors = sorted(condition['name'] for condition in environment.get('conditions') or [] if condition.get('conditionType') == 'environmentState')
+        layout.append((environment['name'], predecessors))
+    return layout
+
+class Stage:
+    __slots__ = ('name', 'depends_on')
+
+    def __init__(self, name, depends_on=None):
+        self.name = name
+        # None chains the stage after the one listed before it, [] starts it when the release starts
+        self.depends_on = depends_on
+
+    @classmethod
+    def fromSpec(cls, spec):
+        if isinstance(spec, dict):
+            depends_on = spec.get('depends_on')
+            if isinstance(depends_on, str):
+                depends_on = [depends_on]
+            return cls(spec['name'], None if depends_on is None else list(depends_on))
+        name, separator, dependencies = str(spec).partition(':')
+        if not separator:
+            return cls(name)
+        return cls(name, [dependency.strip() for dependency in dependencies.split(',') if dependency.strip()])
+
+class ReleaseStageGraph:
+    def __init__(self, stages):
+        self.stages = []
+        self.predecessors = {}
+        previous = None
+        for stage in stages:
+            if stage.name in self.predecessors:
+                raise ValueError("Stage " + stage.name + " is defined more than once; release stage names must be unique")
+            if stage.depends_on is None:
+                predecessors = [previous] if previous is not None else []
+            else:
+                predecessors = stage.depends_on
+            self.predecessors[stage.name] = predecessors
+            self.stages.append(stage.name)
+            previous = stage.name
+        self.order = self.topologicalOrder()
+
+    @classmethod
+    def fromSpecs(cls, specs):
+        return cls([Stage.fromSpec(spec) for spec in specs])
+
+    def __len__(self):
+        return len(self.stages)
+
+    def layout(self):
+        return [(name, sorted(self.predecessors[name])) for name in self.order]
+
+    def topologicalOrder(self):
+        dependents = {name: [] for name in self.stages}
+        waiting_on = {}
+        for name in self.stages:
+            for predecessor in self.predecessors[name]:
+                if predecessor not in dependents:
+                    raise ValueError("Stage " + name + " depends on unknown stage " + predecessor)
+                dependents[predecessor].append(name)
+            waiting_on[name] = len(self.predecessors[name])
+
+        # Ready stages keep their listed order, so a plain list of names keeps its ranks
+        ready = deque(name for name in self.stages if waiting_on[name] == 0)
+        order = []
+        while ready:
+            name = ready.popleft()
+            order.append(name)
+            for dependent in dependents[name]:
+                waiting_on[dependent] -= 1
+                if waiting_on[dependent] == 0:
+                    ready.append(dependent)
+        if len(order) != len(self.stages):
+            raise ValueError("Release stages contain a dependency cycle")
+        return order
+
+class StageEdit:
+    # Changes made to the stages a definition already has: removes first, then replaces, then adds.
+    # Adding a stage that exists only changes what it waits for, so running the same edit twice changes nothing the second time.
+    def __init__(self, add=None, replace=None, remove=None):
+        self.add = [Stage.fromSpec(spec) for spec in add or []]
+        self.replace = [Stage.fromSpec(spec) for spec in replace or []]
+        self.remove = list(remove or [])
+        names = [stage.name for stage in self.add + self.replace] + self.remove
+        if len(set(names)) != len(names):
+            raise ValueError("A stage can only be added, replaced or removed once")
+
+    def apply(self, layout):
+        # layout is stageLayout() of the current stages; returns the edited ReleaseStageGraph and the stages to build again
+        stages = [Stage(name, list(predecessors)) for name, predecessors in layout]
+        for name in self.remove:
+            removed = next((stage for stage in stages if stage.name == name), None)
+            if removed is None:
+                continue
+            stages.remove(removed)
+            for stage in stages:
+                if name in stage.depends_on:
+                    # What waited for the removed stage now waits for what it waited for, so the pipeline stays connected
+                    stage.depends_on = [predecessor for predecessor in stage.depends_on if predecessor != name]
+                    stage.depends_on += [predecessor for predecessor in removed.depends_on if predecessor not in stage.depends_on]
+
+        names = [stage.name for stage in stages]
+        for stage in self.replace:
+            if stage.name not in names:
+                raise ValueError("There is no stage " + stage.name + " to replace")
+        for stage in self.replace + self.add:
+            if stage.name in names:
+                # A stage given without dependencies keeps the ones it has
+                index = names.index(stage.name)
+                depends_on = stage.depends_on if stage.depends_on is not None else stages[index].depends_on
+                stages[index] = Stage(stage.name, depends_on)
+            else:
+                depends_on = stage.depends_on if stage.depends_on is not None else names[-1:]
+                stages.append(Stage(stage.name, depends_on))
+                names.append(stage.name)
+        return ReleaseStageGraph(stages), [stage.name for stage in self.replace]
+
+class EnvironmentBuilder:
+    def __init__(self, definition_name, queue_id, owner, branch='master'):
+        # Everything that does not depend on the environment id is built once and shared by every stage
+        self.owner = owner
+        self.retention_policy = {"daysToKeep": 30, "releasesToKeep": 3, "retainBuild": True}
+        self.approval_options = {"requiredApproverCount": None, "releaseCreatorCanBeApprover": False,
+                                 "autoTriggeredAndPreviousEnvironmentApprovedCanBeSkipped": False, "enforceIdentityRevalidation": False,
+                                 "timeoutInMinutes": 0, "executionOrder": "afterSuccessfulGates"}
+        self.deploy_phases = [{
+            "deploymentInput": {"agentSpecification": {"identifier": "vs2017-win2016"}, "parallelExecution": {"parallelExecutionType": "none"},
+                                "skipArtifactsDownload": False, "artifactsDownloadInput": {}, "queueId": queue_id, "demands": [],
+                                "enableAccessToken": False, "timeoutInMinutes": 0, "jobCancelTimeoutInMinutes": 1,
+                                "condition": "succeeded()", "overrideInputs": {}},
+            "rank": 1, "phaseType": "agentBasedDeployment", "name": "Run on agent", "workflowTasks": []
+        }]
+        self.environment_options = {"emailNotificationType": "OnlyOnFailure", "emailRecipients": "release.environment.owner;release.creator",
+                                    "skipArtifactsDownload": False, "timeoutInMinutes": 0, "enableAccessToken": False,
+                                    "publishDeploymentStatus": False, "badgeEnabled": False, "autoLinkWorkItems": False,
+                                    "pullRequestDeploymentEnabled": False}
+        self.execution_policy = {"concurrencyCount": 0, "queueDepthCount": 0}
+        self.properties = {"properties": {"LinkBoardsWorkItems": {"$type": "System.String", "$value": "False"}}}
+        self.artifact_condition = {
+            "name": "_" + definition_name,
+            "conditionType": "artifact",
+            "value": "{\"sourceBranch\":\"" + branch + "\",\"tags\":[],\"useBuildDefinitionBranch\":false,\"createReleaseOnBuildTagging\":false}"
+        }
+        self.release_started_condition = {"name": "ReleaseStarted", "conditionType": "event", "value": ""}
+
+    def build(self, graph, first_environment_id):
+        environments = []
+        for rank, name in enumerate(graph.order, start=1):
+            environments.append(self.buildEnvironment(name, graph.predecessors[name], first_environment_id + rank - 1, rank))
+        return environments
+
+    def merge(self, graph, existing_environments, first_environment_id, rebuild=()):
+        # Stages that already exist keep their id, tasks and settings; only their rank and stage conditions change.
+        # A stage named in rebuild keeps only its id and is built again like a new one.
+        existing = {environment['name']: environment for environment in existing_environments}
+        environments = []
+        environment_id = first_environment_id
+        for rank, name in enumerate(graph.order, start=1):
+            predecessors = graph.predecessors[name]
+            if name in existing and name in rebuild:
+                environment = self.buildEnvironment(name, predecessors, existing[name]['id'], rank)
+            elif name in existing:
+                environment = dict(existing[name])
+                kept = [condition for condition in environment.get('conditions') or [] if condition.get('conditionType') not in STAGE_CONDITION_TYPES]
+                environment['conditions'] = kept + self.stageConditions(predecessors)
+                environment['rank'] = rank
+            else:
+                environment = self.buildEnvironment(name, predecessors, environment_id, rank)
+                environment_id = environment_id + 1
+            environments.append(environment)
+        return environments
+
+    def stageConditions(self, predecessors):
+        if not predecessors:
+            return [self.release_started_condition]
+        # Several predecessors make a fan-in gate: the stage waits for all of them to succeed
+        return [{"name": predecessor, "conditionType": "environmentState", "value": SUCCEEDED_STATE} for predecessor in predecessors]
+
+    def buildEnvironment(self, name, predecessors, environment_id, rank):
+        conditions = [self.artifact_condition] + self.stageConditions(predecessors)
+        return {
+            "id": environment_id,
+            "name": name,
+            "retentionPolicy": self.retention_policy,
+            "preDeployApprovals": {"approvals": [{"rank": 1, "isAutomated": False, "isNotificationOn": False,
+                                                  "approver": {"displayName": None, "id": APPROVER_ID}, "id": environment_id}]},
+            "postDeployApprovals": {"approvals": [{"rank": 1, "isAutomated": True, "isNotificationOn": False, "id": environment_id}],
+                                    "approvalOptions": self.approval_options},
+            "deployPhases": self.deploy_phases,
+            "environmentOptions": self.environment_options,
+            "demands": [],
+            "conditions": conditions,
+            "executionPolicy": self.execution_policy,
+            "schedules": [],
+            "properties": self.properties,
+            "preDeploymentGates": {"id": environment_id, "gatesOptions": None, "gates": []},
+            "postDeploymentGates": {"id": environment_id, "gatesOptions": None, "gates": []},
+            "environmentTriggers": [],
+            "rank": rank,
+            "owner": self.owner
+        }
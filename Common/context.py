@@ -0,0 +1,218 @@
+import asyncio
+import contextvars
+import importlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, quote
+
+from msrest import Serializer, Deserializer
+from .transport import AdoTransport, checkResponse
+from . import pagination
+from .identity import IdentityResolver, AsyncIdentityResolver
+from .environment_ids import EnvironmentIdAllocator, AsyncEnvironmentIdAllocator
+
+DEFAULT_POOL_NAME = 'Azure Pipelines'
+JSON_HEADERS = {'Content-type': 'application/json'}
+
+def modelClasses(models):
+    # The same model map the SDK clients build, so REST payloads read by the async engine become the objects the SDK returns
+    return {name: value for name, value in models.__dict__.items() if isinstance(value, type)}
+
+class modelDeserializer:
+    # The SDK model modules are slow to import, so a module is only loaded once a payload has to be read with it
+    def __init__(self, module_name):
+        self.module_name = module_name
+        self.deserializer = None
+
+    def __call__(self, target, data):
+        if self.deserializer is None:
+            self.deserializer = Deserializer(modelClasses(importlib.import_module(self.module_name)))
+        return self.deserializer(target, data)
+
+def modelSerializer(module_name):
+    return Serializer(modelClasses(importlib.import_module(module_name)))
+
+CORE_MODELS = modelDeserializer('azure.devops.v6_0.core.models')
+TASK_AGENT_MODELS = modelDeserializer('azure.devops.v6_0.task_agent.models')
+
+def newQueue(pool, queues, project_id):
+    from azure.devops.v6_0.task_agent.models import TaskAgentQueue
+    from azure.devops.v5_1.task_agent.models import TaskAgentPoolReference
+
+    reference = TaskAgentPoolReference(id=pool.id, is_hosted=pool.is_hosted, is_legacy=pool.is_legacy,
+                                       name=pool.name, pool_type=pool.pool_type, scope=pool.scope, size=pool.size)
+    return TaskAgentQueue(id=max([x.id for x in queues] + [0]) + 1, name=DEFAULT_POOL_NAME, pool=reference, project_id=project_id)
+
+class lazy_property:
+    # Resolved once per context on first access; later reads hit the instance dict without locking
+    def __init__(self, function):
+        self.function = function
+        self.name = function.__name__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with instance.lockFor(self.name):
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.function(instance)
+        return instance.__dict__[self.name]
+
+class AdoContext:
+    def __init__(self, organization_url, azure_project_name, personal_access_token, transport=None, identity_resolver=None):
+        self.organization_url = organization_url
+        self.organization_name = urlparse(organization_url).path.split('/')[-1]
+        self.azure_project_name = azure_project_name
+        self.personal_access_token = personal_access_token
+        self.transport = transport or AdoTransport(personal_access_token)
+        self.connection = self.transport.connection(organization_url)
+        if identity_resolver is not None:
+            self.__dict__['identity_resolver'] = identity_resolver
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def lockFor(self, name):
+        with self.lock:
+            return self.locks.setdefault(name, threading.Lock())
+
+    def prefetch(self, *names):
+        pending = [name for name in names if name not in self.__dict__]
+        if len(pending) < 2:
+            for name in pending:
+                getattr(self, name)
+            return
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            for future in [executor.submit(contextvars.copy_context().run, getattr, self, name) for name in pending]:
+                future.result()
+
+    @lazy_property
+    def core_client(self):
+        return self.connection.clients.get_core_client()
+
+    @lazy_property
+    def git_client(self):
+        return self.connection.clients.get_git_client()
+
+    @lazy_property
+    def build_client(self):
+        return self.connection.clients.get_build_client()
+
+    @lazy_property
+    def release_client(self):
+        return self.connection.clients.get_release_client()
+
+    @lazy_property
+    def task_agent_client(self):
+        return self.connection.clients_v6_0.get_task_agent_client()
+
+    @lazy_property
+    def project_info(self):
+        return self.core_client.get_project(self.azure_project_name)
+
+    @lazy_property
+    def project_last_update_time(self):
+        url = self.organization_url + '/_apis/projects/' + self.project_info.id + '?api-version=6.0'
+        project = self.transport.get(url)
+        return json.loads(project.text)['lastUpdateTime']
+
+    @lazy_property
+    def pool(self):
+        pools = self.task_agent_client.get_agent_pools(pool_name=DEFAULT_POOL_NAME)
+        for item in pools:
+            if item.name == DEFAULT_POOL_NAME:
+                return item
+        print("A problem has occured - default azure hosted pipeline not found")
+
+    @lazy_property
+    def queue(self):
+        # Queues are looked up by project name so this does not wait for project_info
+        queues = self.task_agent_client.get_agent_queues(self.azure_project_name)
+        for item in queues:
+            if item.name == DEFAULT_POOL_NAME:
+                return item
+
+        print('Creating a new agent queue')
+        new_queue = newQueue(self.pool, queues, self.project_info.id)
+        return self.task_agent_client.add_agent_queue(new_queue, project=self.project_info.id)
+
+    @lazy_property
+    def environment_ids(self):
+        return EnvironmentIdAllocator(self.release_client, self.project_info.id)
+
+    @lazy_property
+    def identity_resolver(self):
+        return IdentityResolver(self.transport, self.organization_name)
+
+class lazy_coroutine:
+    # Started once per context on first access and shared by every caller awaiting it; a lookup that failed is started again by the next caller
+    def __init__(self, function):
+        self.function = function
+        self.name = function.__name__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        task = instance.tasks.get(self.name)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = instance.tasks[self.name] = asyncio.ensure_future(self.function(instance))
+        return task
+
+class AsyncAdoContext:
+    # The async engine's AdoContext: the same project lookups, made with AsyncAdoTransport instead of the SDK clients
+    def __init__(self, organization_url, azure_project_name, personal_access_token, transport, identity_resolver=None):
+        self.organization_url = organization_url
+        self.organization_name = urlparse(organization_url).path.split('/')[-1]
+        self.azure_project_name = azure_project_name
+        self.personal_access_token = personal_access_token
+        self.transport = transport
+        self.identity_resolver = identity_resolver or AsyncIdentityResolver(transport, self.organization_name)
+        self.environment_ids = AsyncEnvironmentIdAllocator(self)
+        self.tasks = {}
+
+    async def prefetch(self, *names):
+        await asyncio.gather(*[getattr(self, name) for name in names])
+
+    async def getJson(self, url, params=None):
+        response = await self.transport.get(url, params=params)
+        return checkResponse(response, "GET " + url).json()
+
+    async def iterPages(self, url, params=None):
+        # The 'value' list of each page, fetched as the previous one is used up
+        async for response in pagination.asyncResponsePages(self.transport.get, url, params):
+            yield checkResponse(response, "GET " + url).json()['value']
+
+    async def getCollection(self, url, params=None):
+        return [item async for page in self.iterPages(url, params) for item in page]
+
+    async def postJson(self, url, body, params=None, action=None):
+        response = await self.transport.post(url, data=json.dumps(body), params=params, headers=JSON_HEADERS)
+        return checkResponse(response, action or "POST " + url).json()
+
+    @lazy_coroutine
+    async def project_info(self):
+        project = await self.getJson(self.organization_url + '/_apis/projects/' + quote(self.azure_project_name, safe=''), {'api-version': '6.0'})
+        return CORE_MODELS('TeamProject', project)
+
+    @lazy_coroutine
+    async def pool(self):
+        pools = await self.getCollection(self.organization_url + '/_apis/distributedtask/pools', {'poolName': DEFAULT_POOL_NAME, 'api-version': '6.0-preview.1'})
+        for item in TASK_AGENT_MODELS('[TaskAgentPool]', pools):
+            if item.name == DEFAULT_POOL_NAME:
+                return item
+        print("A problem has occured - default azure hosted pipeline not found")
+
+    @lazy_coroutine
+    async def queue(self):
+        url = self.organization_url + '/' + quote(self.azure_project_name, safe='') + '/_apis/distributedtask/queues'
+        queues = TASK_AGENT_MODELS('[TaskAgentQueue]', await self.getCollection(url, {'api-version': '6.0-preview.1'}))
+        for item in queues:
+            if item.name == DEFAULT_POOL_NAME:
+                return item
+
+        print('Creating a new agent queue')
+        pool, project_info = await asyncio.gather(self.pool, self.project_info)
+        new_queue = newQueue(pool, queues, project_info.id)
+        body = modelSerializer('azure.devops.v6_0.task_agent.models').body(new_queue, 'TaskAgentQueue')
+        created = await self.postJson(self.organization_url + '/' + project_info.id + '/_apis/distributedtask/queues', body,
+                                      {'api-version': '6.0-preview.1'}, "Creating agent queue")
+        return TASK_AGENT_MODELS('TaskAgentQueue', created)
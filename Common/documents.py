@@ -0,0 +1,8 @@
+import json
+
+def loadDocument(path):
+    with open(path, 'r') as document_file:
+        if path.endswith('.yml') or path.endswith('.yaml'):
+            import yaml
+            return yaml.safe_load(document_file)
+        return json.load(document_file)
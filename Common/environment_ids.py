@@ -0,0 +1,94 @@
+import asyncio
+import os
+import threading
+
+from . import pagination
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks (Windows) each run only keeps its own ids apart and relies on the server refusing a clash
+    fcntl = None
+
+DEFAULT_RESERVATIONS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'azure-devops-quickstart', 'environment_ids')
+
+class IdReservations:
+    # The highest environment id handed out per project, in a file locked while it is read and moved on, so runs on this
+    # machine never pick the same ids even before either has created its definitions. Runs on other machines are not seen.
+    def __init__(self, directory=None):
+        self.directory = directory or DEFAULT_RESERVATIONS_DIR
+
+    def reserve(self, project_id, high_water_mark, count):
+        # Returns the first of count ids above both high_water_mark and every id reserved before
+        if fcntl is None:
+            return high_water_mark + 1
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, str(project_id)), 'a+') as reservation_file:
+            fcntl.flock(reservation_file, fcntl.LOCK_EX)
+            try:
+                reservation_file.seek(0)
+                reserved = int(reservation_file.read().strip() or 0)
+                first_id = max(high_water_mark, reserved) + 1
+                reservation_file.seek(0)
+                reservation_file.truncate()
+                reservation_file.write(str(first_id + count - 1))
+                reservation_file.flush()
+            finally:
+                fcntl.flock(reservation_file, fcntl.LOCK_UN)
+        return first_id
+
+class EnvironmentIdAllocator:
+    def __init__(self, release_client, project_id, reservations=None):
+        self.release_client = release_client
+        self.project_id = project_id
+        self.reservations = reservations or IdReservations()
+        self.high_water_mark = None
+        self.lock = threading.Lock()
+
+    def allocate(self, count):
+        with self.lock:
+            if self.high_water_mark is None:
+                self.high_water_mark = self.scanHighWaterMark()
+            first_id = self.reservations.reserve(self.project_id, self.high_water_mark, count)
+            self.high_water_mark = first_id + count - 1
+            return first_id
+
+    def invalidate(self):
+        with self.lock:
+            self.high_water_mark = None
+
+    def scanHighWaterMark(self):
+        # Expanding environments in the list query costs one request per page instead of one per definition
+        highest_id = 0
+        for definition in pagination.items(lambda continuation_token: self.release_client.get_release_definitions(
+                project=self.project_id, expand='environments', continuation_token=continuation_token)):
+            for environment in definition.environments or []:
+                highest_id = max(highest_id, environment.id)
+        return highest_id
+
+class AsyncEnvironmentIdAllocator:
+    def __init__(self, context, reservations=None):
+        self.context = context
+        self.reservations = reservations or IdReservations()
+        self.high_water_mark = None
+        self.lock = asyncio.Lock()
+
+    async def allocate(self, count):
+        async with self.lock:
+            if self.high_water_mark is None:
+                self.high_water_mark = await self.scanHighWaterMark()
+            # The file is only held for a read and a write, short enough not to hand to a thread
+            first_id = self.reservations.reserve((await self.context.project_info).id, self.high_water_mark, count)
+            self.high_water_mark = first_id + count - 1
+            return first_id
+
+    def invalidate(self):
+        self.high_water_mark = None
+
+    async def scanHighWaterMark(self):
+        project_info = await self.context.project_info
+        url = 'https://vsrm.dev.azure.com/' + self.context.organization_name + '/' + project_info.id + '/_apis/release/definitions'
+        highest_id = 0
+        async for definitions in self.context.iterPages(url, {'$expand': 'environments', 'api-version': '6.0'}):
+            highest_id = max([environment['id'] for definition in definitions for environment in definition.get('environments') or []] + [highest_id])
+        return highest_id
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+from . import pagination
+
+class Identity:
+    def __init__(self, email, descriptor, entitlement_id, display_name):
+        self.email = email
+        self.descriptor = descriptor
+        self.entitlement_id = entitlement_id
+        self.display_name = display_name
+
+class IdentityResolver:
+    def __init__(self, transport, organization_name, ttl=3600, cache_path=None):
+        self.transport = transport
+        self.organization_name = organization_name
+        self.ttl = ttl
+        self.cache_path = cache_path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.lookup_locks = {}
+        if cache_path:
+            self.loadCache()
+
+    def resolve(self, email):
+        key = email.lower()
+        entry = self.getEntry(key)
+        if entry is not None and entry.get('entitlement_id'):
+            return self.toIdentity(key, entry)
+
+        # Concurrent lookups of the same email wait for the first one instead of scanning the graph again
+        with self.lookupLock(key):
+            entry = self.getEntry(key)
+            if entry is None:
+                entry = self.findUser(key)
+            if entry is None:
+                raise LookupError("User " + email + " was not found in organisation " + self.organization_name)
+            if not entry.get('entitlement_id'):
+                entry['entitlement_id'] = self.getEntitlementId(entry['descriptor'])
+                self.putEntry(key, entry)
+                self.saveCache()
+            return self.toIdentity(key, entry)
+
+    def findUser(self, key):
+        url = "https://vssps.dev.azure.com/" + self.organization_name + "/_apis/graph/users"
+        params = {'api-version': '5.0-preview.1'}
+        found = None
+        for response in pagination.responsePages(self.transport.get, url, params):
+            response.raise_for_status()
+            found = self.cacheUsers(json.loads(response.text)['value'], key)
+            if found is not None:
+                break
+        self.saveCache()
+        return found
+
+    def cacheUsers(self, users, key):
+        # Every user on a fetched page is cached so later lookups can skip the scan; returns the entry for key if the page has it
+        found = None
+        for user in users:
+            principal_name = (user.get('principalName') or '').lower()
+            if not principal_name:
+                continue
+            descriptor = user.get('descriptor') or urlparse(user['url']).path.split('/')[-1]
+            entry = {'descriptor': descriptor, 'display_name': user.get('displayName'), 'entitlement_id': None}
+            if self.getEntry(principal_name) is None:
+                self.putEntry(principal_name, entry)
+            if principal_name == key:
+                found = entry
+        return found
+
+    def getEntitlementId(self, descriptor):
+        response = self.transport.get('https://vsaex.dev.azure.com/' + self.organization_name + '/_apis/userentitlements/' + descriptor + '?api-version=6.0')
+        response.raise_for_status()
+        return json.loads(response.text)['id']
+
+    def getEntry(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['expires'] < time.time():
+                return None
+            return dict(entry)
+
+    def putEntry(self, key, entry):
+        entry = dict(entry)
+        entry['expires'] = time.time() + self.ttl
+        with self.lock:
+            self.entries[key] = entry
+
+    def lookupLock(self, key):
+        with self.lock:
+            return self.lookup_locks.setdefault(key, threading.Lock())
+
+    def toIdentity(self, key, entry):
+        return Identity(email=key, descriptor=entry['descriptor'], entitlement_id=entry['entitlement_id'], display_name=entry.get('display_name'))
+
+    def loadCache(self):
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        with self.lock:
+            for key, entry in cached.get(self.organization_name, {}).items():
+                if entry.get('expires', 0) > now:
+                    self.entries[key] = entry
+
+    def saveCache(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            cached = {}
+        now = time.time()
+        with self.lock:
+            cached[self.organization_name] = {key: entry for key, entry in self.entries.items() if entry['expires'] > now}
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so concurrent runs never read a half written cache
+        handle, temporary_path = tempfile.mkstemp(dir=directory, prefix='.identity_cache_')
+        with os.fdopen(handle, 'w') as cache_file:
+            json.dump(cached, cache_file)
+        os.replace(temporary_path, self.cache_path)
+
+class AsyncIdentityResolver(IdentityResolver):
+    # Shares the cache and its file with IdentityResolver; only the lookups are awaited
+    async def resolve(self, email):
+        key = email.lower()
+        entry = self.getEntry(key)
+        if entry is not None and entry.get('entitlement_id'):
+            return self.toIdentity(key, entry)
+
+        async with self.lookupLock(key):
+            entry = self.getEntry(key)
+            if entry is None:
+                entry = await self.findUser(key)
+            if entry is None:
+                raise LookupError("User " + email + " was not found in organisation " + self.organization_name)
+            if not entry.get('entitlement_id'):
+                entry['entitlement_id'] = await self.getEntitlementId(entry['descriptor'])
+                self.putEntry(key, entry)
+                self.saveCache()
+            return self.toIdentity(key, entry)
+
+    async def findUser(self, key):
+        url = "https://vssps.dev.azure.com/" + self.organization_name + "/_apis/graph/users"
+        params = {'api-version': '5.0-preview.1'}
+        found = None
+        pages = pagination.asyncResponsePages(self.transport.get, url, params)
+        async for response in pages:
+            response.raise_for_status()
+            found = self.cacheUsers(response.json()['value'], key)
+            if found is not None:
+                break
+        await pages.aclose()
+        self.saveCache()
+        return found
+
+    async def getEntitlementId(self, descriptor):
+        response = await self.transport.get('https://vsaex.dev.azure.com/' + self.organization_name + '/_apis/userentitlements/' + descriptor + '?api-version=6.0')
+        response.raise_for_status()
+        return response.json()['id']
+
+    def lookupLock(self, key):
+        # Every coroutine runs on the event loop's thread, so the dict needs no lock of its own
+        return self.lookup_locks.setdefault(key, asyncio.Lock())
@@ -0,0 +1,128 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'azure-devops-quickstart', 'metadata.json')
+# An entry with an ETag is revalidated on every read, so it is only dropped once nobody has asked for it in this long
+MAX_AGE = 7 * 24 * 3600
+
+# The slow changing GETs worth caching: (resource, path below the host, seconds an entry is used without asking the server
+# when the response carried no ETag). Release definitions live under the 'Release' area when the SDK builds the route.
+CACHED_RESOURCES = [
+    ('projects', re.compile(r'^/[^/]+/_apis/projects/[^/]+/?$', re.IGNORECASE), 24 * 3600),
+    ('distributedtask/pools', re.compile(r'^/[^/]+/_apis/distributedtask/pools/?$', re.IGNORECASE), 24 * 3600),
+    ('distributedtask/queues', re.compile(r'^/[^/]+/[^/]+/_apis/distributedtask/queues/?$', re.IGNORECASE), 3600),
+    ('build/definitions', re.compile(r'^/[^/]+/[^/]+/_apis/build/definitions/?$', re.IGNORECASE), 600),
+    ('release/definitions', re.compile(r'^/[^/]+/[^/]+/_apis/release/definitions/?$', re.IGNORECASE), 600),
+]
+# Writes that change a cached resource without going through its own route
+WRITE_ALIASES = {'pipelines': 'build/definitions'}
+CACHED_HEADERS = ('Content-Type', 'x-ms-continuationtoken', 'ETag')
+
+def defaultCachePath():
+    return os.environ.get('PROJECT_SETUP_METADATA_CACHE') or DEFAULT_CACHE_PATH
+
+class MetadataCache:
+    # A read-through cache of GET responses, keyed by URL. cache_path=None keeps it in memory for the run.
+    def __init__(self, cache_path=None, namespace=''):
+        self.cache_path = cache_path
+        # Responses from a different endpoint (PROJECT_SETUP_ADO_ENDPOINT) must never answer for the real service
+        self.namespace = namespace
+        self.entries = {}
+        self.invalidated = set()
+        self.lock = threading.Lock()
+        if cache_path:
+            self.loadCache()
+
+    def resourceFor(self, url):
+        path = urlsplit(url).path
+        for resource, pattern, ttl in CACHED_RESOURCES:
+            if pattern.match(path):
+                return resource, ttl
+        return None
+
+    def scopeFor(self, url):
+        # Entries are invalidated per organisation: a project can appear in a URL by name or by id
+        parts = urlsplit(url)
+        return parts.netloc.lower() + '/' + parts.path.lstrip('/').split('/')[0].lower()
+
+    def key(self, url):
+        return self.namespace + ' ' + url
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.entries.get(self.key(url))
+            if entry is None or entry['stored'] + MAX_AGE < time.time():
+                return None
+            return dict(entry)
+
+    def isFresh(self, entry):
+        return not entry.get('etag') and entry['expires'] > time.time()
+
+    def store(self, url, headers, content):
+        resource, ttl = self.resourceFor(url)
+        now = time.time()
+        entry = {'resource': resource, 'scope': self.scopeFor(url), 'etag': headers.get('ETag'), 'content': content.decode('utf-8'),
+                 'headers': {name: headers[name] for name in CACHED_HEADERS if headers.get(name) is not None}, 'stored': now, 'expires': now + ttl}
+        with self.lock:
+            self.entries[self.key(url)] = entry
+            self.invalidated.discard(self.key(url))
+
+    def revalidated(self, url):
+        with self.lock:
+            entry = self.entries.get(self.key(url))
+            if entry is not None:
+                entry['stored'] = time.time()
+
+    def invalidateFor(self, url):
+        # Called for every write we send, whether or not it succeeded: a conflict usually means our copy is out of date
+        segments = [segment.lower() for segment in urlsplit(url).path.split('/') if segment]
+        if '_apis' not in segments:
+            return
+        written = '/'.join(segments[segments.index('_apis') + 1:])
+        resources = set(resource for resource, _, _ in CACHED_RESOURCES if written.startswith(resource))
+        resources.update(resource for prefix, resource in WRITE_ALIASES.items() if written.startswith(prefix))
+        if not resources:
+            return
+        scope = self.scopeFor(url)
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry['scope'] == scope and entry['resource'] in resources:
+                    del self.entries[key]
+                    self.invalidated.add(key)
+
+    def loadCache(self):
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        oldest = time.time() - MAX_AGE
+        with self.lock:
+            self.entries.update((key, entry) for key, entry in cached.items() if entry.get('stored', 0) > oldest)
+
+    def save(self):
+        if not self.cache_path:
+            return
+        # Another run may have saved since this one loaded, so its entries are kept unless this run invalidated them
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            cached = {}
+        oldest = time.time() - MAX_AGE
+        with self.lock:
+            for key, entry in self.entries.items():
+                if entry['stored'] >= cached.get(key, {}).get('stored', 0):
+                    cached[key] = entry
+            cached = {key: entry for key, entry in cached.items() if key not in self.invalidated and entry.get('stored', 0) > oldest}
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        os.makedirs(directory, exist_ok=True)
+        handle, temporary_path = tempfile.mkstemp(dir=directory, prefix='.metadata_cache_')
+        with os.fdopen(handle, 'w') as cache_file:
+            json.dump(cached, cache_file)
+        os.replace(temporary_path, self.cache_path)
@@ -0,0 +1,62 @@
+# Azure DevOps list APIs return one page at a time, with a continuation token for the next. These generators only ask
+# for the next page once the caller has used up the current one, so a caller that stops early stops the requests too
+# and never holds more than one page.
+
+CONTINUATION_HEADER = 'x-ms-continuationtoken'
+
+def pages(fetch):
+    # fetch(continuation_token) is an SDK list call whose response has .value and .continuation_token
+    continuation_token = None
+    while True:
+        page = fetch(continuation_token)
+        yield page.value
+        continuation_token = page.continuation_token
+        if not continuation_token:
+            return
+
+def items(fetch, where=None):
+    for page in pages(fetch):
+        for item in page:
+            if where is None or where(item):
+                yield item
+
+def first(iterable, where=None):
+    # None when nothing matches
+    for item in iterable:
+        if where is None or where(item):
+            return item
+    return None
+
+def responsePages(get, url, params=None):
+    # get is a transport's get; every response is yielded before its continuation header is followed, so check it there
+    params = dict(params or {})
+    while True:
+        response = get(url, params=params)
+        yield response
+        continuation_token = response.headers.get(CONTINUATION_HEADER)
+        if not continuation_token:
+            return
+        params['continuationToken'] = continuation_token
+
+async def asyncResponsePages(get, url, params=None):
+    params = dict(params or {})
+    while True:
+        response = await get(url, params=params)
+        yield response
+        continuation_token = response.headers.get(CONTINUATION_HEADER)
+        if not continuation_token:
+            return
+        params['continuationToken'] = continuation_token
+
+async def asyncCollect(iterator, where=None):
+    return [item async for item in iterator if where is None or where(item)]
+
+async def asyncFirst(iterator, where=None):
+    # Closing the generator here rather than when it is collected keeps its transport from outliving the lookup
+    try:
+        async for item in iterator:
+            if where is None or where(item):
+                return item
+        return None
+    finally:
+        await iterator.aclose()
@@ -0,0 +1,208 @@
+import asyncio
+import contextvars
+import inspect
+import json
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# Path segments that name a collection; the segment after one is an id or a name and is folded into {id}
+COLLECTIONS = {'projects', 'repositories', 'definitions', 'pushes', 'userentitlements', 'users', 'queues', 'pools', 'pipelines', 'ResourceAreas'}
+IDENTIFIER = re.compile(r'^([0-9a-fA-F-]{32,40}|\d+)$')
+
+current_phase = contextvars.ContextVar('current_phase', default=None)
+active_tracer = None
+
+def install(tracer):
+    global active_tracer
+    active_tracer = tracer
+    return tracer
+
+def active():
+    return active_tracer
+
+def routeTemplate(path):
+    segments = [segment for segment in path.split('/') if segment]
+    if '_apis' not in segments:
+        return '/'.join(segments)
+    api_index = segments.index('_apis')
+    # Organisation and project come before _apis
+    route = ['{organization}', '{project}'][:api_index]
+    previous = None
+    for segment in segments[api_index:]:
+        if previous in ('refs', 'items'):
+            route.append('{*path}')
+            break
+        route.append('{id}' if previous in COLLECTIONS or IDENTIFIER.match(segment) else segment)
+        previous = segment
+    return '/'.join(route)
+
+def recordResponse(response, *args, **kwargs):
+    # Installed as a requests response hook on every AdoTransport session; costs nothing until a tracer is installed
+    if active_tracer is not None:
+        active_tracer.recordRequest(response)
+
+@contextmanager
+def phase(name):
+    token = current_phase.set(name)
+    try:
+        with span(name, category='phase'):
+            yield
+    finally:
+        current_phase.reset(token)
+
+@contextmanager
+def span(name, category='span'):
+    tracer = active_tracer
+    if tracer is None:
+        yield
+        return
+    started = time.perf_counter()
+    # Coroutines share the event loop's thread, so its CPU time cannot be split between them
+    cpu_started = time.thread_time() if not inEventLoop() else None
+    try:
+        yield
+    finally:
+        tracer.emit({'type': category, 'name': name, 'phase': current_phase.get(), 'start': started - tracer.origin, 'duration': time.perf_counter() - started,
+                     'cpu': time.thread_time() - cpu_started if cpu_started is not None else None, 'thread': threading.get_ident()})
+
+def inEventLoop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+def traced(name, function):
+    def run(*args):
+        with phase(name):
+            result = function(*args)
+        # A coroutine has not run yet, so the phase is opened again around awaiting it
+        if inspect.isawaitable(result):
+            return tracedAwait(name, result)
+        return result
+    return run
+
+async def tracedAwait(name, awaitable):
+    with phase(name):
+        return await awaitable
+
+class Tracer:
+    def __init__(self):
+        self.events = []
+        self.hooks = []
+        # Hooks that have raised, each reported the first time only
+        self.failed_hooks = set()
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.cpu_origin = time.process_time()
+
+    def addHook(self, hook):
+        # A hook is called with every event dict as it is recorded, from whichever thread recorded it
+        self.hooks.append(hook)
+
+    def emit(self, event):
+        with self.lock:
+            self.events.append(event)
+        for hook in self.hooks:
+            # Events are emitted from inside requests that already succeeded, so a hook must never fail the call that recorded them
+            try:
+                hook(event)
+            except Exception as error:
+                with self.lock:
+                    first_failure = hook not in self.failed_hooks
+                    self.failed_hooks.add(hook)
+                if first_failure:
+                    print("Trace hook " + getattr(hook, '__qualname__', repr(hook)) + " failed, later failures are not shown: "
+                          + type(error).__name__ + ": " + str(error), file=sys.stderr)
+
+    def recordRequest(self, response):
+        request = response.request
+        retries = getattr(response.raw, 'retries', None)
+        received = response.headers.get('Content-Length')
+        self.recordExchange(request.method, response.url, response.status_code, response.elapsed.total_seconds(), len(request.body or b''),
+                            int(received) if received is not None else len(response.content), len(retries.history) if retries is not None else 0)
+
+    def recordExchange(self, method, url, status, latency, bytes_sent, bytes_received, retries):
+        finished = time.perf_counter()
+        url = urlsplit(url)
+        self.emit({
+            'type': 'request',
+            'method': method,
+            'host': url.netloc,
+            'route': routeTemplate(url.path),
+            'status': status,
+            'start': finished - latency - self.origin,
+            'duration': latency,
+            'bytes_sent': bytes_sent,
+            'bytes_received': bytes_received,
+            'retries': retries,
+            'phase': current_phase.get(),
+            'thread': threading.get_ident()
+        })
+
+    def requests(self):
+        with self.lock:
+            return [event for event in self.events if event['type'] == 'request']
+
+    def spans(self):
+        with self.lock:
+            return [event for event in self.events if event['type'] != 'request']
+
+    def printSummary(self):
+        requests = self.requests()
+        routes = {}
+        for event in requests:
+            key = (event['method'], event['host'], event['route'])
+            route = routes.setdefault(key, {'count': 0, 'errors': 0, 'time': 0.0, 'bytes': 0, 'retries': 0})
+            route['count'] += 1
+            route['errors'] += 1 if event['status'] >= 400 else 0
+            route['time'] += event['duration']
+            route['bytes'] += event['bytes_received']
+            route['retries'] += event['retries']
+
+        print("")
+        print("Requests  Errors  Retries  Total s   Mean ms  KB      Route")
+        for (method, host, route), totals in sorted(routes.items(), key=lambda item: -item[1]['time']):
+            print(str(totals['count']).ljust(8) + "  " + str(totals['errors']).ljust(6) + "  " + str(totals['retries']).ljust(7) + "  "
+                  + format(totals['time'], '.2f').ljust(8) + "  " + format(1000 * totals['time'] / totals['count'], '.0f').ljust(7) + "  "
+                  + format(totals['bytes'] / 1024.0, '.0f').ljust(6) + "  " + method + " " + host + "/" + route)
+
+        print("")
+        print("Phase        Wall s   CPU s    Requests")
+        phases = {}
+        for event in requests:
+            phases.setdefault(event['phase'], {'wall': 0.0, 'cpu': 0.0, 'requests': 0})['requests'] += 1
+        for event in self.spans():
+            if event['type'] == 'phase':
+                totals = phases.setdefault(event['name'], {'wall': 0.0, 'cpu': 0.0, 'requests': 0})
+                totals['wall'] += event['duration']
+                totals['cpu'] = totals['cpu'] + event['cpu'] if totals['cpu'] is not None and event['cpu'] is not None else None
+        for name, totals in phases.items():
+            cpu = format(totals['cpu'], '.2f') if totals['cpu'] is not None else "-"
+            print(str(name or 'setup').ljust(11) + "  " + format(totals['wall'], '.2f').ljust(7) + "  " + cpu.ljust(7) + "  " + str(totals['requests']))
+        for event in self.spans():
+            if event['type'] == 'span':
+                print(event['name'] + " took " + format(event['duration'], '.2f') + "s")
+
+        print("")
+        print(str(len(requests)) + " requests in " + format(time.perf_counter() - self.origin, '.2f') + "s, "
+              + format(time.process_time() - self.cpu_origin, '.2f') + "s CPU")
+
+    def writeChromeTrace(self, path):
+        # Loads in chrome://tracing or https://ui.perfetto.dev
+        trace_events = []
+        for event in list(self.events):
+            if event['type'] == 'request':
+                name = event['method'] + " " + event['host'] + "/" + event['route']
+                arguments = {key: event[key] for key in ('status', 'bytes_sent', 'bytes_received', 'retries', 'phase')}
+            else:
+                name = event['name']
+                arguments = {'cpu_seconds': event['cpu'], 'phase': event['phase']}
+            trace_events.append({'name': name, 'cat': event['type'], 'ph': 'X', 'ts': event['start'] * 1e6, 'dur': event['duration'] * 1e6,
+                                 'pid': 1, 'tid': event['thread'], 'args': arguments})
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, trace_file)
@@ -0,0 +1,318 @@
+import asyncio
+import datetime
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+from azure.devops.connection import Connection
+from msrest.authentication import BasicAuthentication
+from . import tracing
+
+# ADO answers 429 when a caller is throttled and 503 while a service is shedding load.
+# Neither has been processed by the server, so retrying is safe even for POST.
+RETRY_STATUS_CODES = (429, 503)
+
+def checkResponse(response, action):
+    if response.status_code >= 400:
+        raise RuntimeError(action + " failed with HTTP " + str(response.status_code) + ": " + response.text[:500])
+    return response
+
+class ThrottlingRetry(Retry):
+    # urllib3 does not sleep before the first retry when the server sends no Retry-After header
+    def get_backoff_time(self):
+        if not self.history:
+            return 0
+        return min(self.BACKOFF_MAX, self.backoff_factor * (2 ** (len(self.history) - 1)))
+
+    def sleep_for_retry(self, response=None):
+        # urllib3 treats Retry-After: 0 as missing and backs off instead; like AsyncAdoTransport, 0 retries at once
+        retry_after = self.get_retry_after(response)
+        if retry_after is None:
+            return False
+        time.sleep(retry_after)
+        return True
+
+class EndpointAdapter(HTTPAdapter):
+    # Sends https://<host>/<path> to <endpoint>/<host>/<path>, so every Azure DevOps host can be served by one local stand-in
+    def __init__(self, endpoint, **kwargs):
+        self.endpoint = endpoint.rstrip('/')
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        original_url = request.url
+        parts = urlsplit(original_url)
+        if parts.scheme == 'https':
+            request.url = self.endpoint + '/' + parts.netloc + parts.path + ('?' + parts.query if parts.query else '')
+        response = super().send(request, **kwargs)
+        request.url = original_url
+        response.url = original_url
+        return response
+
+class MetadataCachingSession(requests.Session):
+    # Every request, including the SDK clients', goes through send, so this is where cached metadata answers GETs
+    def __init__(self, metadata_cache):
+        super().__init__()
+        self.metadata_cache = metadata_cache
+
+    def send(self, request, **kwargs):
+        cache = self.metadata_cache
+        url = request.url
+        if request.method != 'GET':
+            response = super().send(request, **kwargs)
+            cache.invalidateFor(url)
+            return response
+        if cache.resourceFor(url) is None:
+            return super().send(request, **kwargs)
+
+        entry = cache.lookup(url)
+        if entry is not None and cache.isFresh(entry):
+            return self.cachedResponse(request, entry)
+        if entry is not None and entry['etag']:
+            request.headers['If-None-Match'] = entry['etag']
+        response = super().send(request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            cache.revalidated(url)
+            return self.cachedResponse(request, entry)
+        if response.status_code == 200:
+            cache.store(url, response.headers, response.content)
+        return response
+
+    def cachedResponse(self, request, entry):
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['content'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.elapsed = datetime.timedelta(0)
+        return response
+
+class PooledConnection(Connection):
+    def __init__(self, base_url, creds, session):
+        super().__init__(base_url=base_url, creds=creds)
+        self.session = session
+        # Connection only exposes this hook for its debugging proxy, but every client it builds passes through it,
+        # including the location clients it creates internally to look up resource areas
+        self.use_fiddler = True
+
+    def _configure_client_for_fiddler(self, client):
+        client.config.session_configuration_callback = self.useSharedSession
+
+    def useSharedSession(self, session, global_config, local_config, **kwargs):
+        kwargs['session'] = self.session
+        return kwargs
+
+class AdoTransport:
+    def __init__(self, personal_access_token, pool_maxsize=32, retries=5, backoff_factor=1, timeout=(10, 120), endpoint=None, metadata_cache=None):
+        self.personal_access_token = personal_access_token
+        self.endpoint = endpoint or os.environ.get('PROJECT_SETUP_ADO_ENDPOINT')
+        self.metadata_cache = metadata_cache
+        if metadata_cache is not None:
+            metadata_cache.namespace = self.endpoint or ''
+        self.credentials = BasicAuthentication('', personal_access_token)
+        self.timeout = timeout
+        self.session = self.createSession(pool_maxsize, retries, backoff_factor)
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def createSession(self, pool_maxsize, retries, backoff_factor):
+        retry = ThrottlingRetry(total=retries, connect=retries, read=0, status=retries,
+                                status_forcelist=RETRY_STATUS_CODES, allowed_methods=False,
+                                backoff_factor=backoff_factor, respect_retry_after_header=True,
+                                raise_on_status=False)
+        # requests keeps one keep-alive pool per host, so dev.azure.com, vsrm, vssps and vsaex each reuse their connections
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize, max_retries=retry)
+        session = MetadataCachingSession(self.metadata_cache) if self.metadata_cache is not None else requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if self.endpoint:
+            session.mount('https://', EndpointAdapter(self.endpoint, pool_connections=8, pool_maxsize=pool_maxsize, max_retries=retry))
+        session.auth = HTTPBasicAuth('user', self.personal_access_token)
+        session.hooks['response'].append(tracing.recordResponse)
+        return session
+
+    def connection(self, organization_url):
+        with self.lock:
+            if organization_url not in self.connections:
+                self.connections[organization_url] = PooledConnection(organization_url, self.credentials, self.session)
+            return self.connections[organization_url]
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+        if self.metadata_cache is not None:
+            self.metadata_cache.save()
+
+def loadAiohttp():
+    # aiohttp is only needed by the async engine, so the default engine runs without it
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError("The async engine needs aiohttp, install it with: pip install aiohttp")
+    return aiohttp
+
+class AsyncResponse:
+    # The parts of requests.Response the providers read, so checkResponse and the identity lookups work with either transport
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        checkResponse(self, "Request to " + self.url)
+
+class AsyncAdoTransport:
+    # Drives every request from one event loop. Each Azure DevOps host gets its own bounded semaphore,
+    # so hundreds of concurrent operations still keep at most per_host_limit requests in flight per host.
+    def __init__(self, personal_access_token, per_host_limit=16, retries=5, backoff_factor=1, timeout=(10, 120), endpoint=None, metadata_cache=None):
+        self.aiohttp = loadAiohttp()
+        self.personal_access_token = personal_access_token
+        self.endpoint = (endpoint or os.environ.get('PROJECT_SETUP_ADO_ENDPOINT') or '').rstrip('/') or None
+        self.metadata_cache = metadata_cache
+        if metadata_cache is not None:
+            metadata_cache.namespace = self.endpoint or ''
+        self.per_host_limit = per_host_limit
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.semaphores = {}
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def createSession(self):
+        connect_timeout, read_timeout = self.timeout
+        # The semaphores do the limiting, so the connector keeps one keep-alive connection per request in flight
+        connector = self.aiohttp.TCPConnector(limit=0, limit_per_host=0)
+        return self.aiohttp.ClientSession(connector=connector, auth=self.aiohttp.BasicAuth('user', self.personal_access_token),
+                                          timeout=self.aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout))
+
+    def semaphoreFor(self, host):
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.BoundedSemaphore(self.per_host_limit)
+        return self.semaphores[host]
+
+    def targetUrl(self, url):
+        parts = urlsplit(url)
+        if self.endpoint and parts.scheme == 'https':
+            return self.endpoint + '/' + parts.netloc + parts.path + ('?' + parts.query if parts.query else '')
+        return url
+
+    async def request(self, method, url, data=None, params=None, headers=None):
+        # The query is part of the URL so the metadata cache and the trace see the page that was asked for
+        if params:
+            url = url + ('&' if '?' in url else '?') + urlencode(params)
+        cache = self.metadata_cache
+        if cache is None:
+            return await self.send(method, url, data, headers)
+        if method != 'GET':
+            response = await self.send(method, url, data, headers)
+            cache.invalidateFor(url)
+            return response
+        if cache.resourceFor(url) is None:
+            return await self.send(method, url, data, headers)
+
+        entry = cache.lookup(url)
+        if entry is not None and cache.isFresh(entry):
+            return AsyncResponse(url, 200, CaseInsensitiveDict(entry['headers']), entry['content'].encode('utf-8'))
+        if entry is not None and entry['etag']:
+            headers = dict(headers or {}, **{'If-None-Match': entry['etag']})
+        response = await self.send(method, url, data, headers)
+        if response.status_code == 304 and entry is not None:
+            cache.revalidated(url)
+            return AsyncResponse(url, 200, CaseInsensitiveDict(entry['headers']), entry['content'].encode('utf-8'))
+        if response.status_code == 200:
+            cache.store(url, response.headers, response.content)
+        return response
+
+    async def send(self, method, url, data=None, headers=None):
+        if self.session is None:
+            self.session = self.createSession()
+        host = urlsplit(url).netloc
+        body = data.encode('utf-8') if isinstance(data, str) else data
+        retries = 0
+        while True:
+            async with self.semaphoreFor(host):
+                started = time.perf_counter()
+                try:
+                    async with self.session.request(method, self.targetUrl(url), data=body, headers=headers) as response:
+                        content = await response.read()
+                except self.aiohttp.ClientConnectorError:
+                    if retries == self.retries:
+                        raise
+                    status = None
+                else:
+                    status = response.status
+                latency = time.perf_counter() - started
+            # Matches ThrottlingRetry: only connection failures and throttling are retried, and the semaphore is released while waiting
+            if status is None or (status in RETRY_STATUS_CODES and retries < self.retries):
+                retries = retries + 1
+                await asyncio.sleep(self.retryDelay(retries, response.headers.get('Retry-After') if status is not None else None))
+                continue
+            break
+
+        tracer = tracing.active()
+        if tracer is not None:
+            tracer.recordExchange(method, url, status, latency, len(body or b''), len(content), retries)
+        return AsyncResponse(url, status, response.headers, content)
+
+    def retryDelay(self, retries, retry_after):
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return min(ThrottlingRetry.BACKOFF_MAX, self.backoff_factor * (2 ** (retries - 1)))
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, data=None, **kwargs):
+        return await self.request('POST', url, data=data, **kwargs)
+
+    async def put(self, url, data=None, **kwargs):
+        return await self.request('PUT', url, data=data, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        if self.session is not None:
+            self.run(self.session.close())
+        self.loop.close()
+        if self.metadata_cache is not None:
+            self.metadata_cache.save()
@@ -1,55 +1,87 @@
+import os
 import sys
-from azure.devops.v6_0.git.models import GitRepositoryCreateOptions
-from azure.devops.connection import Connection
-from msrest.authentication import BasicAuthentication
+from urllib.parse import quote
+from Common.context import AdoContext, modelDeserializer
+from Common import pagination
+from Common.transport import checkResponse
 from . import models as local_models
 
+GIT_MODELS = modelDeserializer('azure.devops.v6_0.git.models')
+
 class AzureDevopsGitRepo:
-    def __init__(self, azure_project_name, personal_access_token, organization_url):
-        self.credentials = BasicAuthentication('', personal_access_token)
-        self.connection = Connection(base_url=organization_url, creds=self.credentials)
-        self.core_client = self.connection.clients.get_core_client()
-        self.azure_project_info = self.getProject(azure_project_name)
-        self.git_client = self.connection.clients.get_git_client()
+    def __init__(self, azure_project_name, personal_access_token, organization_url, transport=None, context=None):
+        self.context = context or AdoContext(organization_url, azure_project_name, personal_access_token, transport=transport)
+        self.transport = self.context.transport
+        self.connection = self.context.connection
+
+    @property
+    def azure_project_info(self):
+        return self.context.project_info
+
+    @property
+    def git_client(self):
+        return self.context.git_client
 
     def createGitRepo(self, name):
         repos = self.git_client.get_repositories(self.azure_project_info.id)
 
         if not any(repo.name == name for repo in repos):
             print("Creating new git repo: " + name)
+            from azure.devops.v6_0.git.models import GitRepositoryCreateOptions
             repo = GitRepositoryCreateOptions(name=name)
             self.git_client.create_repository(repo, project=self.azure_project_info.id)
             repo = self.getRepo(name)
-            git_repo = local_models.GitRepo(full_name=repo.name, url=repo.web_url, default_branch=repo.default_branch, is_fork=repo.is_fork, repo_id=repo.id)
-            return(git_repo)
+            return toGitRepo(repo)
         else:
             print("Repository " + name + " already exists")
     
     def deleteGitRepo(self, name):
-        repos = self.git_client.get_repositories(self.azure_project_info.id)
-        repo = self.getRepo(name) 
+        repo = self.findRepo(name)
 
-        if any(repo.name == name for repo in repos):
+        if repo is not None:
             answer = self.yes_no("Are you sure? Please confirm deletion by typing project name or no [project_name/n]\n", name)
             if answer:
                 print("Removing git repo: " + name)
-                self.git_client.delete_repository(repo.id, project=self.azure_project_info.id)
+                self.deleteRepository(repo.id)
             else:
                 sys.exit("Program exited by user")
         else:
             print("Git repository " + name +  " does not exist")
 
+    def listRepositories(self):
+        return self.git_client.get_repositories(self.azure_project_info.id)
+
+    def findRepo(self, name):
+        # The repositories API has no name filter, so one listing answers both whether it exists and its id
+        return pagination.first(self.listRepositories(), where=lambda repo: repo.name == name)
+
+    def deleteRepository(self, repo_id):
+        self.git_client.delete_repository(repo_id, project=self.azure_project_info.id)
+
+    def pushFiles(self, name, files, message, branch='master'):
+        # One REST push creates the commit on the server, so nothing is cloned or written to disk
+        ref_name = 'refs/heads/' + branch
+        refs = self.git_client.get_refs(name, project=self.azure_project_info.id, filter='heads/' + branch)
+        old_object_id = '0' * 40
+        existing_paths = set()
+        for ref in refs.value:
+            if ref.name == ref_name:
+                old_object_id = ref.object_id
+                items = self.git_client.get_items(name, project=self.azure_project_info.id, recursion_level='Full')
+                existing_paths = set(item.path for item in items)
+
+        from azure.devops.v6_0.git.models import GitPush, GitRefUpdate, GitCommitRef
+        push = GitPush(ref_updates=[GitRefUpdate(name=ref_name, old_object_id=old_object_id)],
+                       commits=[GitCommitRef(comment=message, changes=pushChanges(files, existing_paths))])
+        try:
+            return self.git_client.create_push(push, name, project=self.azure_project_info.id)
+        except Exception as error:
+            raise RuntimeError("Pushing " + ", ".join(sorted(files)) + " to " + name + " failed: " + str(error)) from error
+
     def getRepo(self, name):
         repo = self.git_client.get_repository(name, project=self.azure_project_info.id)
         return repo
 
-    def getProject(self, project_name):
-        project = self.core_client.get_projects(project_name)
-        for value in project.value:
-            if value.name == project_name:
-                azure_project_info = value
-                return azure_project_info
-
     def yes_no(self, answer, name):
         name = name.lower()
         yes = set([name])
@@ -62,4 +94,97 @@ class AzureDevopsGitRepo:
             elif choice in no:
                 return False
             else:
-                print("Please respond with project_name or 'no'")
\ No newline at end of file
+                print("Please respond with project_name or 'no'")
+
+def toGitRepo(repo):
+    return local_models.GitRepo(full_name=repo.name, url=repo.web_url, default_branch=repo.default_branch, is_fork=repo.is_fork, repo_id=repo.id)
+
+def pushChanges(files, existing_paths):
+    changes = []
+    for path, content in files.items():
+        path = '/' + path.lstrip('/')
+        changes.append({
+            'changeType': 'edit' if path in existing_paths else 'add',
+            'item': {'path': path},
+            'newContent': {'content': content, 'contentType': 'rawtext'}
+        })
+    return changes
+
+class AsyncAzureDevopsGitRepo:
+    # The repository operations of AzureDevopsGitRepo as coroutines, sent through the context's AsyncAdoTransport
+    def __init__(self, context):
+        self.context = context
+        self.transport = context.transport
+
+    async def repositoriesUrl(self):
+        project_info = await self.context.project_info
+        return self.context.organization_url + '/' + project_info.id + '/_apis/git/repositories'
+
+    async def createGitRepo(self, name):
+        repos = await self.listRepositories()
+
+        if not any(repo.name == name for repo in repos):
+            print("Creating new git repo: " + name)
+            # The created repository comes back in the response, so it is not read again
+            repo = await self.context.postJson(await self.repositoriesUrl(), {'name': name}, {'api-version': '6.0'}, "Creating git repo " + name)
+            return toGitRepo(GIT_MODELS('GitRepository', repo))
+        else:
+            print("Repository " + name + " already exists")
+
+    async def listRepositories(self):
+        return await pagination.asyncCollect(self.iterRepositories())
+
+    async def iterRepositories(self):
+        # The repositories API returns every repository in one page, but follows a continuation token if one is sent
+        async for page in self.context.iterPages(await self.repositoriesUrl(), {'api-version': '6.0'}):
+            for repo in GIT_MODELS('[GitRepository]', page):
+                yield repo
+
+    async def findRepo(self, name):
+        return await pagination.asyncFirst(self.iterRepositories(), where=lambda repo: repo.name == name)
+
+    async def deleteRepository(self, repo_id):
+        url = await self.repositoriesUrl() + '/' + quote(repo_id, safe='')
+        checkResponse(await self.transport.delete(url, params={'api-version': '6.0'}), "Deleting git repo " + repo_id)
+
+    async def getRepo(self, name):
+        url = await self.repositoriesUrl() + '/' + quote(name, safe='')
+        return GIT_MODELS('GitRepository', await self.context.getJson(url, {'api-version': '6.0'}))
+
+    async def getFileContent(self, name, path):
+        # None when the file does not exist
+        url = await self.repositoriesUrl() + '/' + quote(name, safe='') + '/items'
+        # A single-path items GET answers with the raw file unless JSON is asked for, in the query and in Accept as the SDK does
+        response = await self.transport.get(url, params={'path': path, 'includeContent': 'true', '$format': 'json', 'api-version': '6.0'},
+                                            headers={'Accept': 'application/json'})
+        if response.status_code == 404:
+            return None
+        return checkResponse(response, "Reading " + path + " from " + name).json().get('content')
+
+    async def pushFiles(self, name, files, message, branch='master'):
+        ref_name = 'refs/heads/' + branch
+        repository_url = await self.repositoriesUrl() + '/' + quote(name, safe='')
+        refs = await self.context.getCollection(repository_url + '/refs', {'filter': 'heads/' + branch, 'api-version': '6.0'})
+        old_object_id = '0' * 40
+        existing_paths = set()
+        for ref in refs:
+            if ref['name'] == ref_name:
+                old_object_id = ref['objectId']
+                items = await self.context.getCollection(repository_url + '/items', {'recursionLevel': 'Full', 'api-version': '6.0'})
+                existing_paths = set(item['path'] for item in items)
+
+        push = {'refUpdates': [{'name': ref_name, 'oldObjectId': old_object_id}],
+                'commits': [{'comment': message, 'changes': pushChanges(files, existing_paths)}]}
+        try:
+            return GIT_MODELS('GitPush', await self.context.postJson(repository_url + '/pushes', push, {'api-version': '6.0'}))
+        except RuntimeError as error:
+            raise RuntimeError("Pushing " + ", ".join(sorted(files)) + " to " + name + " failed: " + str(error)) from error
+
+def readSeedFiles(specs):
+    # Each spec is LOCAL_PATH or LOCAL_PATH=REPO_PATH; the repo path defaults to the file name at the repo root
+    files = {}
+    for spec in specs or []:
+        local_path, _, repo_path = spec.partition('=')
+        with open(local_path, 'r') as seed_file:
+            files[repo_path or os.path.basename(local_path)] = seed_file.read()
+    return files
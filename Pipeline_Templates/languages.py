@@ -0,0 +1,48 @@
+import os
+
+from Common.documents import loadDocument
+from .store import LANGUAGE_TEMPLATES
+
+DEFAULT_VARIABLES = {
+    "branch": "master",
+    "pool": "vmImage: ubuntu-latest"
+}
+
+class Language:
+    def __init__(self, name, template=None, path=None, variables=None):
+        self.name = name
+        self.template = template
+        self.path = path
+        self.variables = variables or {}
+
+class LanguageRegistry:
+    def __init__(self, languages_file=None):
+        self.languages = {name: Language(name, template=template) for name, template in LANGUAGE_TEMPLATES.items()}
+        if languages_file:
+            self.load(languages_file)
+
+    def load(self, languages_file):
+        document = loadDocument(languages_file) or {}
+        base_directory = os.path.dirname(os.path.abspath(languages_file))
+        for name, entry in (document.get('languages') or {}).items():
+            entry = entry or {}
+            existing = self.languages.get(name)
+            path = entry.get('path')
+            if path and not os.path.isabs(path):
+                path = os.path.join(base_directory, path)
+            template = entry.get('template')
+            if existing is not None and not path and not template:
+                template, path = existing.template, existing.path
+            if not path and not template:
+                raise ValueError("Language " + name + " in " + languages_file + " needs a 'template' or a 'path'")
+            variables = dict(existing.variables) if existing is not None else {}
+            variables.update(entry.get('variables') or {})
+            self.languages[name] = Language(name, template=template, path=path, variables=variables)
+
+    def get(self, name):
+        if name not in self.languages:
+            raise KeyError("Unknown language " + name + ", choose one of: " + ", ".join(sorted(self.languages)))
+        return self.languages[name]
+
+    def storeTemplates(self):
+        return sorted(set(language.template for language in self.languages.values() if language.template))
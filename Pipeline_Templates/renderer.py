@@ -0,0 +1,74 @@
+import re
+import threading
+
+from .store import TemplateStore
+from .languages import LanguageRegistry, DEFAULT_VARIABLES
+
+PLACEHOLDER = re.compile(r'{{\s*([A-Za-z_][A-Za-z0-9_]*)\s*}}')
+
+class CompiledTemplate:
+    def __init__(self, source):
+        # Literal text and placeholders alternate, so rendering is a single join with no rescanning
+        self.literals = []
+        self.placeholders = []
+        position = 0
+        for match in PLACEHOLDER.finditer(source):
+            self.literals.append(source[position:match.start()])
+            self.placeholders.append((match.group(1), match.group(0)))
+            position = match.end()
+        self.literals.append(source[position:])
+
+    def render(self, variables):
+        parts = [self.literals[0]]
+        for (name, raw), literal in zip(self.placeholders, self.literals[1:]):
+            # Placeholders without a value are left as they are, as the string replacement did before
+            parts.append(formatValue(variables[name]) if name in variables else raw)
+            parts.append(literal)
+        return ''.join(parts)
+
+def parseVariables(specs):
+    variables = {}
+    for spec in specs or []:
+        name, separator, value = spec.partition('=')
+        if not separator or not name:
+            raise ValueError("Template variable " + spec + " must look like NAME=VALUE")
+        variables[name] = value
+    return variables
+
+def formatValue(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(formatValue(item) for item in value) + ']'
+    return str(value)
+
+class TemplateRenderer:
+    def __init__(self, template_store=None, registry=None):
+        self.template_store = template_store or TemplateStore()
+        self.registry = registry or LanguageRegistry()
+        self.compiled = {}
+        self.lock = threading.Lock()
+
+    def render(self, language, variables=None):
+        entry = self.registry.get(language)
+        values = dict(DEFAULT_VARIABLES)
+        values.update(entry.variables)
+        values.update(variables or {})
+        return self.compile(entry).render(values)
+
+    def compile(self, entry):
+        key = entry.path or entry.template
+        compiled = self.compiled.get(key)
+        if compiled is None:
+            with self.lock:
+                compiled = self.compiled.get(key)
+                if compiled is None:
+                    compiled = CompiledTemplate(self.readSource(entry))
+                    self.compiled[key] = compiled
+        return compiled
+
+    def readSource(self, entry):
+        if entry.path:
+            with open(entry.path, 'r') as template_file:
+                return template_file.read()
+        return self.template_store.getFile(entry.template)
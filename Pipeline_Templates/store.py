@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import requests
+
+TEMPLATE_REPOSITORY = 'microsoft/azure-pipelines-yaml'
+# The branch a store is filled from when no --revision is given. It is resolved to the commit sha it points at, and the
+# files are read and recorded at that sha, so two stores recording the same revision always hold the same templates
+DEFAULT_REVISION = 'master'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'azure-devops-quickstart', 'templates')
+
+LANGUAGE_TEMPLATES = {
+    "dotnet": "asp.net.yml",
+    "dotnet-core": "asp.net-core.yml",
+    "node-js": "node.js.yml",
+    "python": "python-package.yml"
+}
+
+def isGitRepository(path):
+    from git import Repo, InvalidGitRepositoryError, NoSuchPathError
+    try:
+        Repo(path)
+    except (InvalidGitRepositoryError, NoSuchPathError):
+        return False
+    return True
+
+class TemplateStore:
+    def __init__(self, root=None):
+        self.root = root or os.environ.get('PROJECT_SETUP_TEMPLATE_CACHE') or DEFAULT_CACHE_DIR
+        self.index = None
+        self.contents = {}
+        self.lock = threading.Lock()
+
+    def getFile(self, file_name):
+        index = self.loadIndex()
+        if file_name not in index['templates']:
+            raise KeyError("Template " + file_name + " is not in the template store at " + self.root + ", run refresh-templates")
+        digest = index['templates'][file_name]
+        if digest not in self.contents:
+            with open(self.objectPath(digest), 'r') as template_file:
+                self.contents[digest] = template_file.read()
+        return self.contents[digest]
+
+    def loadIndex(self):
+        if self.index is not None:
+            return self.index
+        with self.lock:
+            if self.index is None:
+                try:
+                    with open(os.path.join(self.root, 'index.json'), 'r') as index_file:
+                        self.index = json.load(index_file)
+                except (OSError, ValueError):
+                    print("Template store is empty, fetching templates from " + TEMPLATE_REPOSITORY)
+                    self.refreshUnlocked()
+        return self.index
+
+    def refresh(self, revision=None, source=None, file_names=None):
+        with self.lock:
+            return self.refreshUnlocked(revision, source, file_names)
+
+    def refreshUnlocked(self, revision=None, source=None, file_names=None):
+        file_names = sorted(set(file_names or LANGUAGE_TEMPLATES.values()))
+        if source is None:
+            revision = self.resolveGithubRevision(revision or DEFAULT_REVISION)
+            files = self.readFromGithub(revision, file_names)
+            source = 'https://github.com/' + TEMPLATE_REPOSITORY
+        elif isGitRepository(source):
+            # A checkout is read at a commit too, never from its working tree, so the recorded sha says what was stored
+            revision, files = self.readFromGitRepo(source, revision or 'HEAD', file_names)
+        elif os.path.isdir(os.path.join(source, 'templates')):
+            if revision is not None:
+                raise ValueError("--revision needs a git repository as --source, " + source + " is a plain directory")
+            files = self.readFromDirectory(os.path.join(source, 'templates'), file_names)
+        else:
+            raise ValueError(source + " is neither a git repository nor a directory containing templates/")
+
+        templates = {}
+        for file_name, content in files.items():
+            templates[file_name] = self.writeObject(content)
+        index = {'source': source, 'revision': revision, 'templates': templates}
+        self.writeAtomically(os.path.join(self.root, 'index.json'), json.dumps(index, indent=2))
+        self.index = index
+        self.contents = {}
+        return index
+
+    def resolveGithubRevision(self, revision):
+        # A branch or tag moves, so the commit it names now is what gets read and recorded
+        response = requests.get('https://api.github.com/repos/' + TEMPLATE_REPOSITORY + '/commits/' + revision,
+                                headers={'Accept': 'application/vnd.github.sha'}, timeout=(10, 60))
+        response.raise_for_status()
+        return response.text.strip()
+
+    def readFromGithub(self, revision, file_names):
+        files = {}
+        for file_name in file_names:
+            url = 'https://raw.githubusercontent.com/' + TEMPLATE_REPOSITORY + '/' + revision + '/templates/' + file_name
+            response = requests.get(url, timeout=(10, 60))
+            response.raise_for_status()
+            files[file_name] = response.text
+        return files
+
+    def readFromDirectory(self, directory, file_names):
+        files = {}
+        for file_name in file_names:
+            with open(os.path.join(directory, file_name), 'r') as template_file:
+                files[file_name] = template_file.read()
+        return files
+
+    def readFromGitRepo(self, path, revision, file_names):
+        from git import Repo
+        commit = Repo(path).commit(revision)
+        tree = commit.tree / 'templates'
+        return commit.hexsha, {file_name: (tree / file_name).data_stream.read().decode('utf-8') for file_name in file_names}
+
+    def objectPath(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:])
+
+    def writeObject(self, content):
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        path = self.objectPath(digest)
+        if not os.path.exists(path):
+            self.writeAtomically(path, content)
+        return digest
+
+    def writeAtomically(self, path, content):
+        # Concurrent runs may refresh the same store; readers only ever see complete files
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        handle, temporary_path = tempfile.mkstemp(dir=directory, prefix='.tmp_')
+        with os.fdopen(handle, 'w') as temporary_file:
+            temporary_file.write(content)
+        os.replace(temporary_path, path)
@@ -0,0 +1,227 @@
+import threading
+import time
+
+import CICD_Providers.azure_devops as azure_devops_CICD
+import Git_Providers.azure_devops as azure_devops_GIT
+from Common.transport import AdoTransport, AsyncAdoTransport
+from Common.documents import loadDocument
+from Common.identity import IdentityResolver, AsyncIdentityResolver
+from Common.context import AdoContext, AsyncAdoContext
+from Common.tracing import traced
+from Pipeline_Templates.renderer import TemplateRenderer
+from CICD_Providers.release_stages import ReleaseStageGraph
+from .task_graph import TaskGraph, AsyncTaskGraph, SUCCEEDED, FAILED
+
+REQUIRED_FIELDS = ['project_name', 'organisation_name', 'azure_project_name', 'user_email', 'environment_names']
+STEPS = ['repo', 'build', 'release', 'template']
+
+def loadManifest(path):
+    return manifestProjects(loadDocument(path), "Manifest " + path)
+
+def manifestProjects(manifest, source):
+    # source names where the manifest came from in errors, e.g. "Manifest projects.yml"
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('projects'), list):
+        raise ValueError(source + " must contain a 'projects' list")
+
+    defaults = {key: value for key, value in manifest.items() if key != 'projects'}
+    defaults.setdefault('language', 'dotnet')
+    defaults.setdefault('template_variables', {})
+
+    projects = []
+    seen = set()
+    for entry in manifest['projects']:
+        if isinstance(entry, str):
+            entry = {'project_name': entry}
+        project = dict(defaults)
+        project.update(entry)
+        project['template_variables'] = dict(defaults['template_variables'], **(entry.get('template_variables') or {}))
+        missing = [field for field in REQUIRED_FIELDS if not project.get(field)]
+        if missing:
+            raise ValueError("Project " + str(project.get('project_name')) + " is missing: " + ", ".join(missing))
+        if isinstance(project['environment_names'], str):
+            project['environment_names'] = [project['environment_names']]
+        try:
+            ReleaseStageGraph.fromSpecs(project['environment_names'])
+        except (ValueError, KeyError) as error:
+            raise ValueError("Project " + project['project_name'] + " has invalid environment_names: " + str(error))
+        key = (project['organisation_name'], project['azure_project_name'], project['project_name'])
+        if key in seen:
+            raise ValueError("Project " + project['project_name'] + " is listed more than once")
+        seen.add(key)
+        projects.append(project)
+    return projects
+
+class BatchProvisioner:
+    def __init__(self, personal_access_token, max_workers=8, identity_cache=None, template_renderer=None, commit_mode='api', metadata_cache=None):
+        self.personal_access_token = personal_access_token
+        self.metadata_cache = metadata_cache
+        self.commit_mode = commit_mode
+        self.template_renderer = template_renderer or TemplateRenderer()
+        self.max_workers = max_workers
+        self.identity_cache = identity_cache
+        self.transport = self.createTransport()
+        self.identity_resolvers = {}
+        self.lock = threading.Lock()
+
+    def createTransport(self):
+        return AdoTransport(self.personal_access_token, pool_maxsize=max(self.max_workers, 10), metadata_cache=self.metadata_cache)
+
+    def createGraph(self):
+        return TaskGraph(max_workers=self.max_workers)
+
+    def close(self):
+        self.transport.close()
+
+    def getIdentityResolver(self, organisation_name):
+        with self.lock:
+            if organisation_name not in self.identity_resolvers:
+                self.identity_resolvers[organisation_name] = IdentityResolver(self.transport, organisation_name, cache_path=self.identity_cache)
+            return self.identity_resolvers[organisation_name]
+
+    def createProviders(self, organisation_name, azure_project_name, prefetch=('project_info', 'queue')):
+        organization_url = 'https://dev.azure.com/' + organisation_name
+        context = AdoContext(organization_url, azure_project_name, self.personal_access_token, transport=self.transport,
+                             identity_resolver=self.getIdentityResolver(organisation_name))
+        # Fetched together up front so a bad project name fails the providers step rather than every project step
+        context.prefetch(*prefetch)
+        build_pipeline = azure_devops_CICD.AzureDevops(azure_project_name, organization_url, self.personal_access_token, context=context,
+                                                       template_renderer=self.template_renderer)
+        git_repo = azure_devops_GIT.AzureDevopsGitRepo(azure_project_name, self.personal_access_token, organization_url, context=context)
+        return (build_pipeline, git_repo)
+
+    def buildGraph(self, projects):
+        graph = self.createGraph()
+        for project in projects:
+            context_key = ('providers', project['organisation_name'], project['azure_project_name'])
+            if context_key not in graph.tasks:
+                graph.addTask(context_key, self.providersStep(project['organisation_name'], project['azure_project_name']))
+
+            name = project['project_name']
+            keys = {step: (project['organisation_name'], project['azure_project_name'], name, step) for step in STEPS}
+            graph.addTask(keys['repo'], traced('repo', self.repoStep(name)), [context_key])
+            graph.addTask(keys['build'], traced('build', self.buildStep(name)), [context_key, keys['repo']])
+            graph.addTask(keys['template'], traced('template', self.templateStep(name, project)), [context_key, keys['repo']])
+            graph.addTask(keys['release'], traced('release', self.releaseStep(name, project['environment_names'], project['user_email'])), [context_key, keys['build']])
+        return graph
+
+    def providersStep(self, organisation_name, azure_project_name, prefetch=('project_info', 'queue')):
+        return lambda: self.createProviders(organisation_name, azure_project_name, prefetch)
+
+    def repoStep(self, name):
+        def step(providers):
+            git_object = providers[1].createGitRepo(name)
+            if git_object is None:
+                raise RuntimeError("Repository " + name + " already exists")
+            return git_object
+        return step
+
+    def buildStep(self, name):
+        return lambda providers, git_object: providers[0].createBuildPipeline(name, self.personal_access_token, git_object)
+
+    def templateStep(self, name, project):
+        variables = self.templateVariables(project)
+        def step(providers, git_object):
+            git_repo = providers[1] if self.commit_mode == 'api' else None
+            return providers[0].createPipelinesTemplate(name, project['language'], git_repo=git_repo, variables=variables,
+                                                        seed_files=azure_devops_GIT.readSeedFiles(project.get('seed_files')))
+        return step
+
+    def templateVariables(self, project):
+        variables = {'environment_names': project['environment_names']}
+        variables.update(project['template_variables'])
+        return variables
+
+    def releaseStep(self, name, environment_names, user_email):
+        return lambda providers, build: providers[0].createReleasePipeline(name, environment_names, user_email)
+
+    def run(self, projects):
+        graph = self.buildGraph(projects)
+        started = time.perf_counter()
+        tasks = graph.run()
+        elapsed = time.perf_counter() - started
+        return BatchReport(projects, tasks, elapsed)
+
+class AsyncBatchProvisioner(BatchProvisioner):
+    # Runs the same task graph as coroutines on one event loop. Instead of a worker pool,
+    # max_requests_per_host bounds the requests in flight to each Azure DevOps host.
+    def __init__(self, personal_access_token, max_requests_per_host=16, identity_cache=None, template_renderer=None, commit_mode='api', metadata_cache=None):
+        if commit_mode != 'api':
+            raise ValueError("The async engine only commits through the REST push API (--commit_mode api)")
+        self.max_requests_per_host = max_requests_per_host
+        super().__init__(personal_access_token, max_workers=max_requests_per_host, identity_cache=identity_cache,
+                         template_renderer=template_renderer, commit_mode=commit_mode, metadata_cache=metadata_cache)
+
+    def createTransport(self):
+        return AsyncAdoTransport(self.personal_access_token, per_host_limit=self.max_requests_per_host, metadata_cache=self.metadata_cache)
+
+    def createGraph(self):
+        return AsyncTaskGraph(self.transport.run)
+
+    def getIdentityResolver(self, organisation_name):
+        if organisation_name not in self.identity_resolvers:
+            self.identity_resolvers[organisation_name] = AsyncIdentityResolver(self.transport, organisation_name, cache_path=self.identity_cache)
+        return self.identity_resolvers[organisation_name]
+
+    async def createProviders(self, organisation_name, azure_project_name, prefetch=('project_info', 'queue')):
+        organization_url = 'https://dev.azure.com/' + organisation_name
+        context = AsyncAdoContext(organization_url, azure_project_name, self.personal_access_token, self.transport,
+                                  identity_resolver=self.getIdentityResolver(organisation_name))
+        await context.prefetch(*prefetch)
+        build_pipeline = azure_devops_CICD.AsyncAzureDevops(context, template_renderer=self.template_renderer)
+        git_repo = azure_devops_GIT.AsyncAzureDevopsGitRepo(context)
+        return (build_pipeline, git_repo)
+
+    def repoStep(self, name):
+        async def step(providers):
+            git_object = await providers[1].createGitRepo(name)
+            if git_object is None:
+                raise RuntimeError("Repository " + name + " already exists")
+            return git_object
+        return step
+
+class BatchReport:
+    def __init__(self, projects, tasks, elapsed):
+        self.elapsed = elapsed
+        self.results = []
+        for project in projects:
+            context = tasks.get(('providers', project['organisation_name'], project['azure_project_name']))
+            # An apply run only schedules the steps that have something to change
+            keys = {step: (project['organisation_name'], project['azure_project_name'], project['project_name'], step) for step in STEPS}
+            steps = {step: tasks[key] for step, key in keys.items() if key in tasks}
+            ran = [task for task in steps.values() if task.started is not None]
+            wall_time = 0.0
+            if ran:
+                wall_time = max(task.finished for task in ran) - min(task.started for task in ran)
+            succeeded = all(task.status == SUCCEEDED for task in steps.values())
+            errors = [step + ": " + str(task.error) for step, task in steps.items() if task.status == FAILED]
+            if context is not None and context.error is not None:
+                errors.insert(0, "providers: " + str(context.error))
+            self.results.append({
+                'project_name': project['project_name'],
+                'succeeded': succeeded,
+                'wall_time': wall_time,
+                'steps': {step: (task.status, task.duration) for step, task in steps.items()},
+                'errors': errors
+            })
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result['succeeded']]
+
+    def printSummary(self):
+        width = max([len(result['project_name']) for result in self.results] + [7])
+        print("")
+        print("Project".ljust(width) + "  Status     Time     " + "  ".join(step.ljust(16) for step in STEPS))
+        for result in self.results:
+            status = 'succeeded' if result['succeeded'] else 'failed'
+            steps = "  ".join(self.formatStep(result['steps'].get(step)).ljust(16) for step in STEPS)
+            print(result['project_name'].ljust(width) + "  " + status.ljust(9) + "  " + (format(result['wall_time'], '.1f') + "s").ljust(7) + "  " + steps)
+            for error in result['errors']:
+                print("    " + error)
+        print("")
+        print(str(len(self.results) - len(self.failed)) + "/" + str(len(self.results)) + " projects provisioned in " + format(self.elapsed, '.1f') + "s")
+
+    def formatStep(self, step):
+        if step is None:
+            return "-"
+        return step[0] + " " + format(step[1], '.1f') + "s"
@@ -0,0 +1,260 @@
+import asyncio
+import time
+
+from azure.devops.exceptions import AzureDevOpsServiceError
+
+import Git_Providers.azure_devops as azure_devops_GIT
+from Git_Providers import models as local_models
+from CICD_Providers.release_stages import ReleaseStageGraph, stageLayout
+from Common import pagination
+from Common.tracing import traced
+from .batch import BatchReport
+from .task_graph import SUCCEEDED
+
+PIPELINE_PATH = '/azure-pipelines.yml'
+# Up to this many projects per ADO project, definitions are looked up by name; beyond it one full listing is cheaper
+LIST_THRESHOLD = 5
+
+def releaseLayout(definition):
+    environments = []
+    for environment in definition.environments or []:
+        conditions = [{'name': condition.name, 'conditionType': condition.condition_type} for condition in environment.conditions or []]
+        environments.append({'name': environment.name, 'rank': environment.rank, 'conditions': conditions})
+    return stageLayout(environments)
+
+def releaseBuildId(definition):
+    # The id of the build definition the release pipeline's artifact comes from, as a string, or None
+    for artifact in definition.artifacts or []:
+        reference = (artifact.definition_reference or {}).get('definition')
+        if artifact.type == 'Build' and reference is not None:
+            return reference.id
+    return None
+
+class ProjectPlan:
+    def __init__(self, project, providers=None, actions=None, error=None, notes=None):
+        self.project = project
+        self.providers = providers
+        # step -> (description, state the step needs), for the steps that have something to change
+        self.actions = actions or {}
+        self.error = error
+        # Differences that are reported but left alone
+        self.notes = notes or []
+
+    @property
+    def converged(self):
+        return self.error is None and not self.actions
+
+class Plan:
+    def __init__(self, project_plans, elapsed):
+        self.project_plans = project_plans
+        self.elapsed = elapsed
+
+    @property
+    def errors(self):
+        return [project_plan for project_plan in self.project_plans if project_plan.error is not None]
+
+    @property
+    def changes(self):
+        return sum(len(project_plan.actions) for project_plan in self.project_plans)
+
+    def printSummary(self):
+        print("")
+        for project_plan in self.project_plans:
+            name = project_plan.project['project_name']
+            if project_plan.error is not None:
+                print(name + ": could not be planned: " + str(project_plan.error))
+            elif project_plan.converged:
+                print(name + ": up to date")
+            else:
+                print(name + ":")
+                for step, (description, _) in project_plan.actions.items():
+                    print("    " + step.ljust(9) + " " + description)
+            for note in project_plan.notes:
+                print("    note      " + note)
+        print("")
+        converged = len([project_plan for project_plan in self.project_plans if project_plan.converged])
+        print(str(self.changes) + " changes planned, " + str(converged) + "/" + str(len(self.project_plans)) + " projects up to date, planned in " + format(self.elapsed, '.1f') + "s")
+
+class Planner:
+    def __init__(self, provisioner, overwrite_pipeline_file=False):
+        self.provisioner = provisioner
+        # Teams edit their azure-pipelines.yml, so one that differs from the template is only replaced when asked to
+        self.overwrite_pipeline_file = overwrite_pipeline_file
+
+    def plan(self, projects):
+        started = time.perf_counter()
+        graph = self.provisioner.createGraph()
+        groups = {}
+        for project in projects:
+            groups.setdefault((project['organisation_name'], project['azure_project_name']), []).append(project)
+
+        for (organisation_name, azure_project_name), members in groups.items():
+            providers_key = ('providers', organisation_name, azure_project_name)
+            names = [project['project_name'] for project in members]
+            # Looking up the agent queue creates it when it is missing, so plan leaves it to the steps apply runs
+            graph.addTask(providers_key, self.provisioner.providersStep(organisation_name, azure_project_name, prefetch=('project_info',)))
+            graph.addTask(('repos', organisation_name, azure_project_name), self.listRepositories, [providers_key])
+            graph.addTask(('builds', organisation_name, azure_project_name), self.findDefinitions(names, self.iterBuildDefinitions), [providers_key])
+            graph.addTask(('releases', organisation_name, azure_project_name), self.findDefinitions(names, self.iterReleaseDefinitions), [providers_key])
+            for name in names:
+                graph.addTask((organisation_name, azure_project_name, name, 'pipeline_file'), self.pipelineFileStep(name),
+                              [providers_key, ('repos', organisation_name, azure_project_name)])
+        tasks = graph.run()
+
+        project_plans = []
+        for project in projects:
+            group = (project['organisation_name'], project['azure_project_name'])
+            keys = [('providers',) + group, ('repos',) + group, ('builds',) + group, ('releases',) + group, group + (project['project_name'], 'pipeline_file')]
+            failed = [tasks[key] for key in keys if tasks[key].status != SUCCEEDED]
+            if failed:
+                project_plans.append(ProjectPlan(project, error=failed[0].error))
+                continue
+            providers, repos, builds, releases, pipeline_file = [tasks[key].result for key in keys]
+            notes = []
+            try:
+                actions = self.diff(project, providers, repos, builds, releases, pipeline_file, notes)
+            except (ValueError, KeyError) as error:
+                project_plans.append(ProjectPlan(project, error=error))
+                continue
+            project_plans.append(ProjectPlan(project, providers, actions, notes=notes))
+        return Plan(project_plans, time.perf_counter() - started)
+
+    def listRepositories(self, providers):
+        return {repo.name: repo for repo in providers[1].listRepositories()}
+
+    def iterBuildDefinitions(self, providers, name=None):
+        return providers[0].iterBuildDefinitions(name)
+
+    def iterReleaseDefinitions(self, providers, name=None):
+        return providers[0].iterReleaseDefinitions(search_text=name, is_exact_name_match=name is not None, expand='environments,artifacts')
+
+    def listings(self, names, iter_definitions, providers):
+        if len(names) >= LIST_THRESHOLD:
+            return [iter_definitions(providers)]
+        return [iter_definitions(providers, name) for name in names]
+
+    def findDefinitions(self, names, iter_definitions):
+        # Only the wanted definitions are kept as the pages stream past
+        def step(providers):
+            wanted = set(names)
+            return {definition.name: definition for definitions in self.listings(names, iter_definitions, providers)
+                    for definition in definitions if definition.name in wanted}
+        return step
+
+    def pipelineFileStep(self, name):
+        def step(providers, repos):
+            repo = repos.get(name)
+            # A repository without a default branch has no commits, so there is nothing to read
+            if repo is None or not repo.default_branch:
+                return None
+            git_repo = providers[1]
+            try:
+                item = git_repo.git_client.get_item(repo.id, PIPELINE_PATH, project=git_repo.azure_project_info.id, include_content=True)
+            except AzureDevOpsServiceError:
+                return None
+            return item.content
+        return step
+
+    def diff(self, project, providers, repos, builds, releases, pipeline_file, notes):
+        name = project['project_name']
+        actions = {}
+        repo = repos.get(name)
+        if repo is None:
+            actions['repo'] = ("create repository", None)
+        if name not in builds:
+            git_object = None
+            if repo is not None:
+                git_object = local_models.GitRepo(full_name=repo.name, url=repo.web_url, default_branch=repo.default_branch, is_fork=repo.is_fork, repo_id=repo.id)
+            actions['build'] = ("create build pipeline", git_object)
+
+        rendered = providers[0].renderPipelineTemplate(project['language'], self.provisioner.templateVariables(project))
+        if pipeline_file is None:
+            actions['template'] = ("commit " + PIPELINE_PATH.lstrip('/'), True)
+        elif pipeline_file != rendered and self.overwrite_pipeline_file:
+            actions['template'] = ("update " + PIPELINE_PATH.lstrip('/') + " from the " + project['language'] + " template", False)
+        elif pipeline_file != rendered:
+            notes.append(PIPELINE_PATH.lstrip('/') + " differs from the " + project['language'] + " template and is left as it is (--overwrite_pipeline_file replaces it)")
+
+        graph = ReleaseStageGraph.fromSpecs(project['environment_names'])
+        definition = releases.get(name)
+        if definition is None:
+            actions['release'] = ("create release pipeline with stages " + ", ".join(graph.order), None)
+        else:
+            # A build pipeline created again gets a new id, which the release pipeline's artifact has to follow
+            build = builds.get(name)
+            relink = build is None or releaseBuildId(definition) != str(build.id)
+            changes = []
+            if relink:
+                changes.append("point release pipeline at the " + ("new " if build is None else "") + "build pipeline")
+            if releaseLayout(definition) != graph.layout():
+                changes.append("update release stages to " + ", ".join(graph.order))
+            if changes:
+                actions['release'] = (", ".join(changes), (definition.id, build.id if relink and build is not None else None, relink))
+        return actions
+
+    def apply(self, plan):
+        graph = self.provisioner.createGraph()
+        for project_plan in plan.project_plans:
+            if not project_plan.converged:
+                self.addActions(graph, project_plan)
+        started = time.perf_counter()
+        tasks = graph.run()
+        elapsed = time.perf_counter() - started
+        return BatchReport([project_plan.project for project_plan in plan.project_plans], tasks, elapsed)
+
+    def addActions(self, graph, project_plan):
+        project = project_plan.project
+        providers = project_plan.providers
+        name = project['project_name']
+        actions = project_plan.actions
+        keys = {step: (project['organisation_name'], project['azure_project_name'], name, step) for step in actions}
+
+        if 'repo' in actions:
+            graph.addTask(keys['repo'], traced('repo', lambda: self.provisioner.repoStep(name)(providers)), [])
+        repo_dependencies = [keys['repo']] if 'repo' in actions else []
+        if 'build' in actions:
+            existing = actions['build'][1]
+            graph.addTask(keys['build'], traced('build', lambda *created: providers[0].createBuildPipeline(name, self.provisioner.personal_access_token,
+                                                                                                            created[0] if created else existing)), repo_dependencies)
+        if 'template' in actions:
+            graph.addTask(keys['template'], traced('template', self.templateStep(project, providers, actions['template'][1])), repo_dependencies)
+        if 'release' in actions:
+            if actions['release'][1] is None:
+                step = lambda *built: providers[0].createReleasePipeline(name, project['environment_names'], project['user_email'])
+            else:
+                # A build created first passes on its id; otherwise the id found while planning is used
+                definition_id, build_definition_id, relink = actions['release'][1]
+                step = lambda *built: providers[0].updateReleaseEnvironments(definition_id, project['environment_names'], project['user_email'],
+                                                                            build_definition_id=(built[0] if built else build_definition_id) if relink else None)
+            graph.addTask(keys['release'], traced('release', step), [keys['build']] if 'build' in actions else [])
+
+    def templateStep(self, project, providers, first_commit):
+        variables = self.provisioner.templateVariables(project)
+        def step(*created):
+            # Seed files are only part of the first commit, later runs leave them to the repository's owners
+            seed_files = azure_devops_GIT.readSeedFiles(project.get('seed_files')) if first_commit else None
+            git_repo = providers[1] if self.provisioner.commit_mode == 'api' else None
+            return providers[0].createPipelinesTemplate(project['project_name'], project['language'], git_repo=git_repo, variables=variables,
+                                                        seed_files=seed_files)
+        return step
+
+class AsyncPlanner(Planner):
+    # For an AsyncBatchProvisioner: the steps that read provider results await them first
+    async def listRepositories(self, providers):
+        return {repo.name: repo for repo in await providers[1].listRepositories()}
+
+    def findDefinitions(self, names, iter_definitions):
+        async def step(providers):
+            wanted = set(names)
+            found = await asyncio.gather(*[pagination.asyncCollect(definitions, where=lambda definition: definition.name in wanted)
+                                           for definitions in self.listings(names, iter_definitions, providers)])
+            return {definition.name: definition for definitions in found for definition in definitions}
+        return step
+
+    def pipelineFileStep(self, name):
+        async def step(providers, repos):
+            repo = repos.get(name)
+            if repo is None or not repo.default_branch:
+                return None
+            return await providers[1].getFileContent(repo.id, PIPELINE_PATH)
+        return step
@@ -0,0 +1,285 @@
+import hmac
+import ipaddress
+import json
+import os
+import queue
+import socketserver
+import stat
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from .batch import BatchProvisioner, manifestProjects
+from .teardown import Teardown, NameMatcher
+from .task_graph import SUCCEEDED, FAILED
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMMANDS = ['create', 'delete']
+DELETE_FIELDS = ['project_name', 'organisation_name', 'azure_project_name']
+# Finished jobs kept for polling; the oldest are forgotten first
+JOB_HISTORY = 1000
+LOOPBACK_HOSTS = ['localhost', 'localhost.']
+
+class WarmProvisioner(BatchProvisioner):
+    # Keeps the providers of every Azure DevOps project a job has used, so later jobs reuse its SDK clients, project,
+    # pool and queue instead of looking them up again
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.providers = {}
+        self.provider_locks = {}
+
+    def createProviders(self, organisation_name, azure_project_name, prefetch=('project_info', 'queue')):
+        key = (organisation_name, azure_project_name)
+        with self.lock:
+            lock = self.provider_locks.setdefault(key, threading.Lock())
+        with lock:
+            # A project that could not be looked up is not kept, so the next job tries again
+            if key not in self.providers:
+                self.providers[key] = super().createProviders(organisation_name, azure_project_name, prefetch)
+            else:
+                self.providers[key][0].context.prefetch(*prefetch)
+            return self.providers[key]
+
+    def warmProjects(self):
+        with self.lock:
+            return sorted(organisation_name + "/" + azure_project_name for organisation_name, azure_project_name in self.providers)
+
+class Job:
+    def __init__(self, command, project):
+        self.id = uuid.uuid4().hex
+        self.command = command
+        self.project = project
+        self.status = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+
+    def toJson(self):
+        view = {'id': self.id, 'command': self.command, 'status': self.status, 'result': self.result, 'error': self.error,
+                'submitted': self.submitted, 'started': self.started, 'finished': self.finished}
+        view.update((field, self.project[field]) for field in DELETE_FIELDS)
+        if self.started is not None:
+            view['queued_seconds'] = self.started - self.submitted
+        if self.finished is not None:
+            view['run_seconds'] = self.finished - self.started
+        return view
+
+class ProvisioningService:
+    # Runs create and delete jobs from a queue, max_jobs at a time, all through one WarmProvisioner
+    def __init__(self, provisioner, registry, max_jobs=4):
+        self.provisioner = provisioner
+        self.registry = registry
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(max_jobs)]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        return self
+
+    def stop(self):
+        # Jobs already queued still run; the providers and caches are only released after them
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.provisioner.close()
+
+    def submit(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("A job must be a JSON object")
+        command = request.get('command')
+        if command not in COMMANDS:
+            raise ValueError("command must be one of: " + ", ".join(COMMANDS))
+        fields = {key: value for key, value in request.items() if key != 'command'}
+        if command == 'create':
+            project = manifestProjects({'projects': [fields]}, "Job")[0]
+            self.registry.get(project['language'])
+        else:
+            missing = [field for field in DELETE_FIELDS if not fields.get(field)]
+            if missing:
+                raise ValueError("Project " + str(fields.get('project_name')) + " is missing: " + ", ".join(missing))
+            project = {field: fields[field] for field in DELETE_FIELDS}
+
+        job = Job(command, project)
+        with self.lock:
+            self.jobs[job.id] = job
+            finished = [job_id for job_id, kept in self.jobs.items() if kept.finished is not None]
+            for job_id in finished[:len(self.jobs) - JOB_HISTORY]:
+                del self.jobs[job_id]
+        self.queue.put(job)
+        return job
+
+    def getJob(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def listJobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def status(self):
+        jobs = self.listJobs()
+        return {'queued': len([job for job in jobs if job.status == QUEUED]), 'running': len([job for job in jobs if job.status == RUNNING]),
+                'workers': len(self.workers), 'warm_projects': self.provisioner.warmProjects()}
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job.status = RUNNING
+            job.started = time.time()
+            try:
+                job.result = self.createProject(job.project) if job.command == 'create' else self.deleteProject(job.project)
+                job.status = SUCCEEDED if not job.result['errors'] else FAILED
+            except Exception as error:
+                job.error = str(error)
+                job.status = FAILED
+            job.finished = time.time()
+            if self.provisioner.metadata_cache is not None:
+                self.provisioner.metadata_cache.save()
+
+    def createProject(self, project):
+        result = self.provisioner.run([project]).results[0]
+        return {'steps': {step: {'status': status, 'seconds': duration} for step, (status, duration) in result['steps'].items()},
+                'errors': result['errors']}
+
+    def deleteProject(self, project):
+        group = (project['organisation_name'], project['azure_project_name'])
+        remover = Teardown(self.provisioner)
+        targets = remover.resolve({group: NameMatcher(names=[project['project_name']])})
+        if targets.errors:
+            raise RuntimeError("Could not list resources: " + str(targets.errors[group]))
+        report = remover.run(targets)
+        failed = report.failed
+        return {'deleted': [target.kind for target in targets.targets if target not in failed],
+                'errors': [target.kind + ": " + str(report.tasks[target.key].error) for target in failed]}
+
+def hostName(host_header):
+    # "127.0.0.1:8090", "[::1]:8090" or "localhost" without the port or IPv6 brackets
+    if host_header.startswith('['):
+        return host_header[1:].partition(']')[0]
+    return host_header.rpartition(':')[0] if host_header.count(':') == 1 else host_header
+
+def isLoopbackHost(host_header):
+    name = hostName(host_header).lower()
+    if name in LOOPBACK_HOSTS:
+        return True
+    try:
+        return ipaddress.ip_address(name).is_loopback
+    except ValueError:
+        return False
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    # POST /jobs queues a job, GET /jobs/ID polls it, GET /jobs lists the jobs kept and GET /status shows the queue.
+    # Deletes run with the daemon's PAT and never ask first, so every request needs the bearer token and a loopback Host
+    # (which a DNS rebinding page cannot send), and jobs must be JSON (which a no-cors page cannot send).
+    protocol_version = 'HTTP/1.1'
+
+    def authorize(self):
+        if not isLoopbackHost(self.headers.get('Host') or ''):
+            self.reply(403, {'error': "Jobs are only accepted with a loopback Host such as localhost or 127.0.0.1"})
+            return False
+        scheme, _, token = (self.headers.get('Authorization') or '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode('utf-8'), self.server.token.encode('utf-8')):
+            self.reply(401, {'error': "A valid Authorization: Bearer token is required"}, {'WWW-Authenticate': 'Bearer'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.authorize():
+            return
+        service = self.server.service
+        path = urlsplit(self.path).path.rstrip('/')
+        if path == '/status':
+            self.reply(200, service.status())
+        elif path == '/jobs':
+            self.reply(200, {'jobs': [job.toJson() for job in service.listJobs()]})
+        elif path.startswith('/jobs/'):
+            job = service.getJob(path[len('/jobs/'):])
+            if job is None:
+                self.reply(404, {'error': "No job " + path[len('/jobs/'):] + ", or it finished too long ago to be kept"})
+            else:
+                self.reply(200, job.toJson())
+        else:
+            self.reply(404, {'error': "Nothing at " + path})
+
+    def do_POST(self):
+        if not self.authorize():
+            return
+        if urlsplit(self.path).path.rstrip('/') != '/jobs':
+            self.reply(404, {'error': "Jobs are submitted to /jobs"})
+            return
+        if (self.headers.get('Content-Type') or '').partition(';')[0].strip().lower() != 'application/json':
+            self.reply(415, {'error': "Jobs must be sent as Content-Type: application/json"})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            job = self.server.service.submit(json.loads(self.rfile.read(length) or b'null'))
+        except (ValueError, KeyError) as error:
+            self.reply(400, {'error': str(error.args[0])})
+            return
+        self.reply(202, job.toJson(), {'Location': '/jobs/' + job.id})
+
+    def reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        if status >= 400:
+            # The request body may not have been read, so the connection cannot be reused
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class JobServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, token):
+        self.service = service
+        self.token = token
+        super().__init__(address, JobRequestHandler)
+
+    @property
+    def url(self):
+        return 'http://' + self.server_address[0] + ':' + str(self.server_address[1])
+
+class UnixJobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # The socket is only readable and writable by its owner, on top of the bearer token and Host checks every request goes through
+    daemon_threads = True
+
+    def __init__(self, path, service, token):
+        self.service = service
+        self.token = token
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        super().__init__(path, JobRequestHandler)
+
+    def server_bind(self):
+        previous = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(previous)
+
+    def server_close(self):
+        super().server_close()
+        os.unlink(self.server_address)
+
+    @property
+    def url(self):
+        return 'unix:' + self.server_address
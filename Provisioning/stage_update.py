@@ -0,0 +1,76 @@
+import time
+
+from Common.tracing import traced
+from .teardown import Teardown, AsyncTeardown
+from .task_graph import SUCCEEDED
+
+class StageUpdatePlan:
+    def __init__(self, definitions, providers, error=None):
+        # definitions maps each selected release definition's name to its id
+        self.definitions = definitions
+        self.providers = providers
+        self.error = error
+
+    def printTargets(self):
+        print("")
+        if self.error is not None:
+            print("Could not list release pipelines: " + str(self.error))
+        for name in sorted(self.definitions):
+            print("release  " + name)
+        print("")
+        print("Found " + str(len(self.definitions)) + " release pipelines")
+
+class StageUpdater:
+    # Edits the stages of every matching release definition, each one a task on the provisioner's graph
+    finder = Teardown
+
+    def __init__(self, provisioner):
+        self.provisioner = provisioner
+
+    def resolve(self, organisation_name, azure_project_name, matcher):
+        graph = self.provisioner.createGraph()
+        graph.addTask('providers', lambda: self.provisioner.createProviders(organisation_name, azure_project_name, prefetch=('project_info',)))
+        graph.addTask('definitions', self.finder(self.provisioner).findReleaseDefinitions(matcher), ['providers'])
+        tasks = graph.run()
+        for key in ('providers', 'definitions'):
+            if tasks[key].status != SUCCEEDED:
+                return StageUpdatePlan({}, None, tasks[key].error)
+        return StageUpdatePlan(tasks['definitions'].result, tasks['providers'].result)
+
+    def run(self, update_plan, stage_edit, user_email=None):
+        graph = self.provisioner.createGraph()
+        for name, definition_id in update_plan.definitions.items():
+            graph.addTask(name, traced('release', self.updateStep(update_plan.providers, definition_id, stage_edit, user_email)))
+        started = time.perf_counter()
+        tasks = graph.run()
+        return StageUpdateReport(update_plan.definitions, tasks, time.perf_counter() - started)
+
+    def updateStep(self, providers, definition_id, stage_edit, user_email):
+        # Returns a coroutine for the async providers, which the async graph awaits
+        return lambda: providers[0].updateReleaseStages(definition_id, stage_edit, user_email)
+
+class AsyncStageUpdater(StageUpdater):
+    finder = AsyncTeardown
+
+class StageUpdateReport:
+    def __init__(self, definitions, tasks, elapsed):
+        self.definitions = definitions
+        self.tasks = tasks
+        self.elapsed = elapsed
+
+    @property
+    def failed(self):
+        return sorted(name for name in self.definitions if self.tasks[name].status != SUCCEEDED)
+
+    @property
+    def updated(self):
+        return sorted(name for name in self.definitions if self.tasks[name].status == SUCCEEDED and self.tasks[name].result is not None)
+
+    def printSummary(self):
+        print("")
+        for name in self.failed:
+            task = self.tasks[name]
+            print("release " + name + " " + task.status + ": " + str(task.error))
+        unchanged = len(self.definitions) - len(self.failed) - len(self.updated)
+        print(str(len(self.updated)) + " release pipelines updated, " + str(unchanged) + " already up to date, " + str(len(self.failed)) + " failed in "
+              + format(self.elapsed, '.1f') + "s")
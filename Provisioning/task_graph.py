@@ -0,0 +1,152 @@
+import asyncio
+import contextvars
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+PENDING = 'pending'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+class Task:
+    def __init__(self, key, function, dependencies):
+        self.key = key
+        self.function = function
+        self.dependencies = list(dependencies)
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+class TaskGraph:
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.tasks = {}
+
+    def addTask(self, key, function, dependencies=()):
+        if key in self.tasks:
+            raise ValueError("Task " + str(key) + " was added twice")
+        self.tasks[key] = Task(key, function, dependencies)
+        return self.tasks[key]
+
+    def run(self):
+        dependents, waiting_on = self.prepare()
+        ready = [key for key, count in waiting_on.items() if count == 0]
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while ready or running:
+                for key in ready:
+                    task = self.tasks[key]
+                    arguments = [self.tasks[dependency].result for dependency in task.dependencies]
+                    # Tasks run with a copy of the caller's context, so a tracing phase set around run() reaches them
+                    running[executor.submit(contextvars.copy_context().run, self.runTask, task, arguments)] = key
+                ready = []
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ready.extend(self.finish(self.tasks[running.pop(future)], dependents, waiting_on))
+        return self.tasks
+
+    def prepare(self):
+        dependents = {key: [] for key in self.tasks}
+        waiting_on = {}
+        for key, task in self.tasks.items():
+            for dependency in task.dependencies:
+                if dependency not in self.tasks:
+                    raise ValueError("Task " + str(key) + " depends on unknown task " + str(dependency))
+                dependents[dependency].append(key)
+            waiting_on[key] = len(task.dependencies)
+        self.checkForCycles(dependents, waiting_on)
+        return dependents, waiting_on
+
+    def finish(self, task, dependents, waiting_on):
+        # Returns the dependents that can start now
+        ready = []
+        if task.status == SUCCEEDED:
+            for dependent in dependents[task.key]:
+                waiting_on[dependent] -= 1
+                if waiting_on[dependent] == 0 and self.tasks[dependent].status == PENDING:
+                    ready.append(dependent)
+        else:
+            self.skipDependents(task.key, dependents)
+        return ready
+
+    def runTask(self, task, arguments):
+        task.started = time.perf_counter()
+        try:
+            task.result = task.function(*arguments)
+            task.status = SUCCEEDED
+        except Exception as error:
+            task.error = error
+            task.status = FAILED
+        task.finished = time.perf_counter()
+
+    def skipDependents(self, key, dependents):
+        stack = list(dependents[key])
+        while stack:
+            dependent = self.tasks[stack.pop()]
+            if dependent.status == PENDING:
+                dependent.status = SKIPPED
+                dependent.error = "skipped because " + str(key) + " did not succeed"
+                stack.extend(dependents[dependent.key])
+
+    def checkForCycles(self, dependents, waiting_on):
+        remaining = dict(waiting_on)
+        stack = [key for key, count in remaining.items() if count == 0]
+        visited = 0
+        while stack:
+            key = stack.pop()
+            visited = visited + 1
+            for dependent in dependents[key]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    stack.append(dependent)
+        if visited != len(self.tasks):
+            raise ValueError("Task graph contains a dependency cycle")
+
+class AsyncTaskGraph(TaskGraph):
+    # Every task runs as a coroutine on one event loop. There is no worker limit: the transport bounds the requests in flight per host.
+    # A task function may return an awaitable, which is awaited before the task counts as finished.
+    def __init__(self, runner):
+        super().__init__(max_workers=None)
+        self.runner = runner
+
+    def run(self):
+        return self.runner(self.runAll())
+
+    async def runAll(self):
+        dependents, waiting_on = self.prepare()
+        ready = [key for key, count in waiting_on.items() if count == 0]
+        running = {}
+        while ready or running:
+            for key in ready:
+                task = self.tasks[key]
+                arguments = [self.tasks[dependency].result for dependency in task.dependencies]
+                running[asyncio.ensure_future(self.runTaskAsync(task, arguments))] = key
+            ready = []
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                ready.extend(self.finish(self.tasks[running.pop(future)], dependents, waiting_on))
+        return self.tasks
+
+    async def runTaskAsync(self, task, arguments):
+        task.started = time.perf_counter()
+        try:
+            result = task.function(*arguments)
+            if inspect.isawaitable(result):
+                result = await result
+            task.result = result
+            task.status = SUCCEEDED
+        except Exception as error:
+            task.error = error
+            task.status = FAILED
+        task.finished = time.perf_counter()
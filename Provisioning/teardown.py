@@ -0,0 +1,196 @@
+import asyncio
+import fnmatch
+import re
+import time
+
+from Common import pagination
+from Common.tracing import traced
+from .plan import LIST_THRESHOLD
+from .task_graph import SUCCEEDED
+
+# Per project name, releases go first because they hold on to builds, and builds before the repository they read from
+KINDS = ['release', 'build', 'repo']
+WILDCARDS = re.compile(r'\[[^\]]*\]|[*?]')
+
+class NameMatcher:
+    def __init__(self, glob=None, regex=None, names=None):
+        self.glob = glob
+        # The whole name has to match, so a short regex cannot reach further than it reads
+        self.regex = re.compile(regex) if regex else None
+        self.names = set(names) if names is not None else None
+
+    def matches(self, name):
+        if self.names is not None:
+            return name in self.names
+        if self.regex is not None:
+            return self.regex.fullmatch(name) is not None
+        return fnmatch.fnmatchcase(name, self.glob)
+
+    def buildFilters(self):
+        # The build definitions API matches * wildcards on the server
+        if self.names is not None:
+            return sorted(self.names) if len(self.names) < LIST_THRESHOLD else [None]
+        if self.glob is not None:
+            return [WILDCARDS.sub('*', self.glob)]
+        return [None]
+
+    def releaseSearches(self):
+        # The release definitions API only matches a substring, or the exact name
+        if self.names is not None:
+            return [(name, True) for name in sorted(self.names)] if len(self.names) < LIST_THRESHOLD else [(None, False)]
+        if self.glob is not None:
+            literal = max(WILDCARDS.split(self.glob), key=len)
+            return [(literal or None, False)]
+        return [(None, False)]
+
+class Target:
+    def __init__(self, kind, organisation_name, azure_project_name, name, resource_id):
+        self.kind = kind
+        self.organisation_name = organisation_name
+        self.azure_project_name = azure_project_name
+        self.name = name
+        self.resource_id = resource_id
+
+    @property
+    def key(self):
+        return (self.organisation_name, self.azure_project_name, self.name, self.kind)
+
+class TeardownPlan:
+    def __init__(self, targets, providers, errors):
+        self.targets = targets
+        self.providers = providers
+        self.errors = errors
+
+    def printTargets(self):
+        print("")
+        for (organisation_name, azure_project_name), error in self.errors.items():
+            print(organisation_name + "/" + azure_project_name + ": could not list resources: " + str(error))
+        for target in self.targets:
+            print(target.organisation_name + "/" + target.azure_project_name + "  " + target.kind.ljust(7) + "  " + target.name)
+        print("")
+        counts = [str(len([target for target in self.targets if target.kind == kind])) + " " + kind + "s" for kind in reversed(KINDS)]
+        print("Found " + ", ".join(counts))
+
+class Teardown:
+    def __init__(self, provisioner):
+        self.provisioner = provisioner
+
+    def resolve(self, matchers):
+        # matchers maps (organisation_name, azure_project_name) to the NameMatcher for that project
+        graph = self.provisioner.createGraph()
+        for (organisation_name, azure_project_name), matcher in matchers.items():
+            providers_key = ('providers', organisation_name, azure_project_name)
+            # Nothing is created while looking, so the agent queue is not resolved
+            graph.addTask(providers_key, lambda organisation_name=organisation_name, azure_project_name=azure_project_name:
+                          self.provisioner.createProviders(organisation_name, azure_project_name, prefetch=('project_info',)))
+            graph.addTask(('repo', organisation_name, azure_project_name), self.findRepositories(matcher), [providers_key])
+            graph.addTask(('build', organisation_name, azure_project_name), self.findBuildDefinitions(matcher), [providers_key])
+            graph.addTask(('release', organisation_name, azure_project_name), self.findReleaseDefinitions(matcher), [providers_key])
+        tasks = graph.run()
+
+        targets = []
+        providers = {}
+        errors = {}
+        for group in matchers:
+            keys = [('providers',) + group] + [(kind,) + group for kind in KINDS]
+            failed = [tasks[key] for key in keys if tasks[key].status != SUCCEEDED]
+            if failed:
+                errors[group] = failed[0].error
+                continue
+            providers[group] = tasks[keys[0]].result
+            for kind in KINDS:
+                for name, resource_id in sorted(tasks[(kind,) + group].result.items()):
+                    targets.append(Target(kind, group[0], group[1], name, resource_id))
+        targets.sort(key=lambda target: (target.organisation_name, target.azure_project_name, target.name, KINDS.index(target.kind)))
+        return TeardownPlan(targets, providers, errors)
+
+    def findRepositories(self, matcher):
+        return lambda providers: {repo.name: repo.id for repo in providers[1].listRepositories() if matcher.matches(repo.name)}
+
+    def findBuildDefinitions(self, matcher):
+        def step(providers):
+            found = {}
+            for name_filter in matcher.buildFilters():
+                for definition in providers[0].iterBuildDefinitions(name_filter):
+                    if matcher.matches(definition.name):
+                        found[definition.name] = definition.id
+            return found
+        return step
+
+    def findReleaseDefinitions(self, matcher):
+        def step(providers):
+            found = {}
+            for search_text, is_exact_name_match in matcher.releaseSearches():
+                for definition in providers[0].iterReleaseDefinitions(search_text=search_text, is_exact_name_match=is_exact_name_match):
+                    if matcher.matches(definition.name):
+                        found[definition.name] = definition.id
+            return found
+        return step
+
+    def run(self, teardown_plan):
+        graph = self.provisioner.createGraph()
+        for target in teardown_plan.targets:
+            providers = teardown_plan.providers[(target.organisation_name, target.azure_project_name)]
+            earlier = [(target.organisation_name, target.azure_project_name, target.name, kind) for kind in KINDS[:KINDS.index(target.kind)]]
+            graph.addTask(target.key, traced(target.kind, self.deleteStep(target, providers)), [key for key in earlier if key in graph.tasks][-1:])
+        started = time.perf_counter()
+        tasks = graph.run()
+        return TeardownReport(teardown_plan.targets, tasks, time.perf_counter() - started)
+
+    def deleteStep(self, target, providers):
+        if target.kind == 'repo':
+            return lambda *deleted: providers[1].deleteRepository(target.resource_id)
+        if target.kind == 'build':
+            return lambda *deleted: providers[0].deleteBuildDefinition(target.resource_id)
+        return lambda *deleted: providers[0].deleteReleaseDefinition(target.resource_id)
+
+class AsyncTeardown(Teardown):
+    # For an AsyncBatchProvisioner: the lookups await the provider listings, the deletes already return coroutines
+    def findRepositories(self, matcher):
+        async def step(providers):
+            return {repo.name: repo.id for repo in await providers[1].listRepositories() if matcher.matches(repo.name)}
+        return step
+
+    def findBuildDefinitions(self, matcher):
+        async def step(providers):
+            listings = await asyncio.gather(*[pagination.asyncCollect(providers[0].iterBuildDefinitions(name_filter), where=self.matchesName(matcher))
+                                              for name_filter in matcher.buildFilters()])
+            return {definition.name: definition.id for definitions in listings for definition in definitions}
+        return step
+
+    def findReleaseDefinitions(self, matcher):
+        async def step(providers):
+            listings = await asyncio.gather(*[pagination.asyncCollect(providers[0].iterReleaseDefinitions(search_text=search_text, is_exact_name_match=is_exact_name_match),
+                                                                      where=self.matchesName(matcher))
+                                              for search_text, is_exact_name_match in matcher.releaseSearches()])
+            return {definition.name: definition.id for definitions in listings for definition in definitions}
+        return step
+
+    def matchesName(self, matcher):
+        return lambda definition: matcher.matches(definition.name)
+
+class TeardownReport:
+    def __init__(self, targets, tasks, elapsed):
+        self.targets = targets
+        self.tasks = tasks
+        self.elapsed = elapsed
+
+    @property
+    def failed(self):
+        return [target for target in self.targets if self.tasks[target.key].status != SUCCEEDED]
+
+    def printSummary(self):
+        print("")
+        for target in self.failed:
+            task = self.tasks[target.key]
+            print(target.kind + " " + target.name + " " + task.status + ": " + str(task.error))
+        print(str(len(self.targets) - len(self.failed)) + "/" + str(len(self.targets)) + " resources deleted in " + format(self.elapsed, '.1f') + "s")
+
+def confirm(question):
+    while True:
+        choice = input(question).lower()
+        if choice in ('yes', 'y'):
+            return True
+        if choice in ('no', 'n', ''):
+            return False
+        print("Please respond with 'yes' or 'no'")
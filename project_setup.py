@@ -1,54 +1,384 @@
 #!/usr/bin/python3
 
 import argparse
-import CICD_Providers.azure_devops as azure_devops_CICD
-import Git_Providers.azure_devops as azure_devops_GIT
+import sys
+
+# Commands import what they use when they run, so --help and argument errors never load the Azure DevOps SDK,
+# msrest, requests or GitPython. Benchmarks/startup.py measures it.
 
 def main():
     parser = argparse.ArgumentParser(prog='Project Setup Utility', 
     description='Creates projects in Azure DevOps & Azure based on inputs The program will create \
         Git Repos, Build Pipelines, Deployment Pipelines & App services')
 
-    subparser = parser.add_subparsers(dest='command')
+    subparser = parser.add_subparsers(dest='command', required=True)
     create = subparser.add_parser('create')
     delete = subparser.add_parser('delete') 
+    batch = subparser.add_parser('batch')
+    plan = subparser.add_parser('plan', help='Show what apply would change for the projects in a manifest')
+    apply = subparser.add_parser('apply', help='Create or update only what differs from the projects in a manifest')
+    teardown = subparser.add_parser('teardown', help='Delete the repos, build and release pipelines of every matching project')
+    update_stages = subparser.add_parser('update-stages', help='Add, replace or remove stages in every release pipeline whose name matches')
+    serve = subparser.add_parser('serve', help='Keep connections and lookups warm and run create and delete jobs sent to a local HTTP API')
+    refresh_templates = subparser.add_parser('refresh-templates')
 
     create.add_argument('--project_name', help='The name of the project you wish to create', required=True, type=str,)
     create.add_argument('--personal_access_token', help='Your Azure DevOps personal access token', required=True, type=str)
     create.add_argument('--organisation_name', help='The name of your organisation in Azure Devops', required=True, type=str)
     create.add_argument('--azure_project_name', help='The name of your project in Azure Devops', required=True, type=str)
     create.add_argument('--user_email', help='Your ADO email address', required=True, type=str)
-    create.add_argument('--environment_names', help='The list of environment names in your release pipelines', required=True, nargs='+')
+    create.add_argument('--environment_names', help='The list of environment names in your release pipelines. Each stage follows the previous one, \
+        or use NAME:DEP1,DEP2 to depend on other stages (NAME: starts with the release)', required=True, nargs='+')
     create.add_argument('--language',
                     default='dotnet',
                     const='dotnet',
                     nargs='?',
-                    choices=['dotnet', 'dotnet-core', 'node-js', 'python'],
-                    help='Language choices: dotnet, dotnet-core, node-js, python (default: %(default)s)')
+                    help='Language choices: dotnet, dotnet-core, node-js, python or any language in --languages_file (default: %(default)s)')
+    create.add_argument('--languages_file', help='A YAML or JSON file adding languages, templates and template variables', type=str)
+    create.add_argument('--template_variable', help='A variable substituted into the pipeline template, as NAME=VALUE', action='append')
     create.add_argument('--location', help='The list of environment names in your release pipelines', type=str)
+    create.add_argument('--identity_cache', help='A file used to cache user identity lookups between runs', type=str)
+    create.add_argument('--template_cache', help='The directory of the local pipeline template store', type=str)
+    create.add_argument('--commit_mode', default='api', choices=['api', 'clone'],
+                    help='Commit azure-pipelines.yml with one REST push (api) or through a local git clone (clone) (default: %(default)s)')
+    create.add_argument('--seed_file', help='An extra file committed with azure-pipelines.yml, as LOCAL_PATH or LOCAL_PATH=REPO_PATH', action='append')
 
     delete.add_argument('--project_name', help='The name of the project you wish to remove', required=True, type=str)
     delete.add_argument('--personal_access_token', help='Your Azure DevOps personal access token', required=True, type=str)
     delete.add_argument('--organisation_name', help='The name of your organisation in Azure Devops', required=True, type=str)
     delete.add_argument('--azure_project_name', help='The name of your project in Azure Devops', required=True, type=str)
 
+    for manifest_command in (batch, plan, apply):
+        manifest_command.add_argument('--manifest', help='A YAML or JSON file listing the projects to create', required=True, type=str)
+        manifest_command.add_argument('--personal_access_token', help='Your Azure DevOps personal access token', required=True, type=str)
+        manifest_command.add_argument('--max_workers', help='The maximum number of provisioning steps run at once (default: %(default)s)', default=8, type=int)
+        manifest_command.add_argument('--identity_cache', help='A file used to cache user identity lookups between runs', type=str)
+        manifest_command.add_argument('--template_cache', help='The directory of the local pipeline template store', type=str)
+        manifest_command.add_argument('--languages_file', help='A YAML or JSON file adding languages, templates and template variables', type=str)
+        manifest_command.add_argument('--commit_mode', default='api', choices=['api', 'clone'],
+                        help='Commit azure-pipelines.yml with one REST push (api) or through a local git clone (clone) (default: %(default)s)')
+
+    for planned_command in (plan, apply):
+        planned_command.add_argument('--overwrite_pipeline_file', help='Replace an azure-pipelines.yml that differs from the rendered template; \
+            by default only a missing one is committed', action='store_true')
+
+    teardown_targets = teardown.add_mutually_exclusive_group(required=True)
+    teardown_targets.add_argument('--pattern', help='A glob such as "preview-*" matched against project names', type=str)
+    teardown_targets.add_argument('--regex', help='A regular expression that must match the whole project name', type=str)
+    teardown_targets.add_argument('--manifest', help='A YAML or JSON manifest whose projects should be removed', type=str)
+    teardown.add_argument('--personal_access_token', help='Your Azure DevOps personal access token', required=True, type=str)
+    teardown.add_argument('--organisation_name', help='The name of your organisation in Azure Devops (required with --pattern or --regex)', type=str)
+    teardown.add_argument('--azure_project_name', help='The name of your project in Azure Devops (required with --pattern or --regex)', type=str)
+    teardown.add_argument('--max_workers', help='The maximum number of deletes run at once (default: %(default)s)', default=8, type=int)
+    teardown.add_argument('--yes', help='Delete without asking for confirmation', action='store_true')
+
+    update_targets = update_stages.add_mutually_exclusive_group(required=True)
+    update_targets.add_argument('--pattern', help='A glob such as "app-*" matched against release pipeline names', type=str)
+    update_targets.add_argument('--regex', help='A regular expression that must match the whole release pipeline name', type=str)
+    update_stages.add_argument('--personal_access_token', help='Your Azure DevOps personal access token', required=True, type=str)
+    update_stages.add_argument('--organisation_name', help='The name of your organisation in Azure Devops', required=True, type=str)
+    update_stages.add_argument('--azure_project_name', help='The name of your project in Azure Devops', required=True, type=str)
+    update_stages.add_argument('--add', help='A stage to add, as NAME or NAME:DEP1,DEP2 (NAME alone follows the last stage). An existing stage \
+        only has its dependencies changed', action='append')
+    update_stages.add_argument('--replace', help='A stage to build again with the standard settings, as NAME (keeping its dependencies) or NAME:DEP1,DEP2', action='append')
+    update_stages.add_argument('--remove', help='A stage to remove; the stages that waited for it wait for what it waited for', action='append')
+    update_stages.add_argument('--user_email', help='The ADO email address that owns added and replaced stages', type=str)
+    update_stages.add_argument('--max_workers', help='The maximum number of release pipelines updated at once (default: %(default)s)', default=8, type=int)
+    update_stages.add_argument('--yes', help='Update without asking for confirmation', action='store_true')
+
+    for engine_command in (batch, plan, apply, teardown, update_stages):
+        engine_command.add_argument('--engine', default='threads', choices=['threads', 'async'],
+                        help='Run steps on a thread pool (threads) or as coroutines on one event loop, which needs aiohttp (async) (default: %(default)s)')
+        engine_command.add_argument('--max_requests_per_host', help='With --engine async, the most requests in flight to each Azure DevOps host \
+            (default: %(default)s)', default=16, type=int)
+
+    serve.add_argument('--personal_access_token', help='Your Azure DevOps personal access token, used for every job', required=True, type=str)
+    serve.add_argument('--host', help='The address to listen on (default: %(default)s)', default='127.0.0.1', type=str)
+    serve.add_argument('--port', help='The port to listen on (default: %(default)s)', default=8090, type=int)
+    serve.add_argument('--socket', help='Listen on this Unix socket instead of a TCP port', type=str)
+    serve.add_argument('--token', help='The bearer token every request must send (default: $PROJECT_SETUP_SERVE_TOKEN, or a new one printed at start)', type=str)
+    serve.add_argument('--max_jobs', help='The most jobs run at once; the rest wait in the queue (default: %(default)s)', default=4, type=int)
+    serve.add_argument('--max_workers', help='The maximum number of provisioning steps run at once per job (default: %(default)s)', default=8, type=int)
+    serve.add_argument('--identity_cache', help='A file used to cache user identity lookups between runs', type=str)
+    serve.add_argument('--template_cache', help='The directory of the local pipeline template store', type=str)
+    serve.add_argument('--languages_file', help='A YAML or JSON file adding languages, templates and template variables', type=str)
+    serve.add_argument('--commit_mode', default='api', choices=['api', 'clone'],
+                    help='Commit azure-pipelines.yml with one REST push (api) or through a local git clone (clone) (default: %(default)s)')
+
+    for cached_command in (create, delete, batch, plan, apply, teardown, update_stages, serve):
+        cached_command.add_argument('--metadata_cache', help='The file caching projects, agent pools, queues and definition lists between runs \
+            (default: $PROJECT_SETUP_METADATA_CACHE or ~/.cache/azure-devops-quickstart/metadata.json)', type=str)
+        cached_command.add_argument('--no_metadata_cache', help='Read all metadata from Azure DevOps and do not keep it for later runs', action='store_true')
+
+    for traced_command in (create, delete, batch, plan, apply, teardown, update_stages):
+        traced_command.add_argument('--trace', help='Write a Chrome trace (chrome://tracing, Perfetto) of every Azure DevOps request to this file \
+            and print a timing summary', type=str)
+        traced_command.add_argument('--trace_hook', help='A MODULE:FUNCTION called with every trace event, e.g. to forward them to a metrics pipeline', type=str)
+
+    refresh_templates.add_argument('--revision', help='The azure-pipelines-yaml commit, branch or tag to store (default: master, or HEAD for a local git repo), recorded as the commit sha it points at', type=str)
+    refresh_templates.add_argument('--source', help='A local checkout or bare git repo of azure-pipelines-yaml to read instead of GitHub', type=str)
+    refresh_templates.add_argument('--template_cache', help='The directory of the local pipeline template store', type=str)
+    refresh_templates.add_argument('--languages_file', help='A YAML or JSON file whose extra templates should also be stored', type=str)
+
     args = parser.parse_args()
 
+    tracer = None
+    if getattr(args, 'trace', None) or getattr(args, 'trace_hook', None):
+        import importlib
+        from Common import tracing
+        tracer = tracing.install(tracing.Tracer())
+        if args.trace_hook:
+            module_name, _, function_name = args.trace_hook.partition(':')
+            tracer.addHook(getattr(importlib.import_module(module_name), function_name))
+    try:
+        run(args)
+    finally:
+        if tracer is not None:
+            tracer.printSummary()
+            if args.trace:
+                tracer.writeChromeTrace(args.trace)
+                print("Trace written to " + args.trace)
+
+def run(args):
+    if args.command == 'refresh-templates':
+        refreshTemplates(args)
+    elif args.command in ('batch', 'plan', 'apply'):
+        provisionManifest(args)
+    elif args.command == 'teardown':
+        teardownProjects(args)
+    elif args.command == 'update-stages':
+        updateStages(args)
+    elif args.command == 'serve':
+        serveJobs(args)
+    else:
+        createOrDeleteProject(args)
+
+def refreshTemplates(args):
+    from Pipeline_Templates.store import TemplateStore
+    from Pipeline_Templates.languages import LanguageRegistry
+
+    try:
+        registry = LanguageRegistry(args.languages_file)
+        index = TemplateStore(args.template_cache).refresh(revision=args.revision, source=args.source, file_names=registry.storeTemplates())
+    except (ValueError, KeyError) as error:
+        sys.exit(str(error.args[0]))
+    print("Stored " + str(len(index['templates'])) + " templates from " + index['source'] + " at revision " + str(index['revision']))
+
+def provisionManifest(args):
+    import Provisioning.batch as batch_provisioning
+    from Provisioning.plan import Planner, AsyncPlanner
+    from Pipeline_Templates.store import TemplateStore
+    from Pipeline_Templates.languages import LanguageRegistry
+    from Pipeline_Templates.renderer import TemplateRenderer
+
+    try:
+        projects = batch_provisioning.loadManifest(args.manifest)
+        registry = LanguageRegistry(args.languages_file)
+        for project in projects:
+            registry.get(project['language'])
+    except (ValueError, KeyError) as error:
+        sys.exit(str(error.args[0]))
+    provisioner = createProvisioner(args, identity_cache=args.identity_cache, template_renderer=TemplateRenderer(TemplateStore(args.template_cache), registry),
+                                    commit_mode=args.commit_mode)
+    try:
+        if args.command == 'batch':
+            report = provisioner.run(projects)
+        else:
+            planner = (AsyncPlanner if args.engine == 'async' else Planner)(provisioner, overwrite_pipeline_file=args.overwrite_pipeline_file)
+            desired_state = planner.plan(projects)
+            desired_state.printSummary()
+            if desired_state.errors:
+                sys.exit(1)
+            if args.command == 'plan' or desired_state.changes == 0:
+                return
+            report = planner.apply(desired_state)
+    finally:
+        provisioner.close()
+    report.printSummary()
+    if report.failed:
+        sys.exit(1)
+
+def teardownProjects(args):
+    import re
+    import Provisioning.batch as batch_provisioning
+    import Provisioning.teardown as teardown_provisioning
+
+    try:
+        if args.manifest:
+            matchers = {}
+            for project in batch_provisioning.loadManifest(args.manifest):
+                group = (project['organisation_name'], project['azure_project_name'])
+                matchers.setdefault(group, set()).add(project['project_name'])
+            matchers = {group: teardown_provisioning.NameMatcher(names=names) for group, names in matchers.items()}
+        elif not args.organisation_name or not args.azure_project_name:
+            sys.exit("--organisation_name and --azure_project_name are required with --pattern or --regex")
+        else:
+            matchers = {(args.organisation_name, args.azure_project_name): teardown_provisioning.NameMatcher(glob=args.pattern, regex=args.regex)}
+    except (ValueError, re.error) as error:
+        sys.exit(str(error.args[0]))
+    provisioner = createProvisioner(args)
+    try:
+        remover = (teardown_provisioning.AsyncTeardown if args.engine == 'async' else teardown_provisioning.Teardown)(provisioner)
+        targets = remover.resolve(matchers)
+        targets.printTargets()
+        if targets.errors:
+            sys.exit(1)
+        if not targets.targets:
+            return
+        if not args.yes and not teardown_provisioning.confirm("Delete all " + str(len(targets.targets)) + " resources listed above? [yes/no]\n"):
+            sys.exit("Program exited by user")
+        report = remover.run(targets)
+    finally:
+        provisioner.close()
+    report.printSummary()
+    if report.failed:
+        sys.exit(1)
+
+def updateStages(args):
+    import re
+    import Provisioning.teardown as teardown_provisioning
+    from Provisioning.stage_update import StageUpdater, AsyncStageUpdater
+    from CICD_Providers.release_stages import StageEdit
+
+    try:
+        stage_edit = StageEdit(add=args.add, replace=args.replace, remove=args.remove)
+        matcher = teardown_provisioning.NameMatcher(glob=args.pattern, regex=args.regex)
+    except (ValueError, re.error) as error:
+        sys.exit(str(error.args[0]))
+    if not (args.add or args.replace or args.remove):
+        sys.exit("Nothing to change: give at least one --add, --replace or --remove")
+    if (args.add or args.replace) and not args.user_email:
+        sys.exit("--user_email is required with --add or --replace")
+    provisioner = createProvisioner(args)
+    try:
+        updater = (AsyncStageUpdater if args.engine == 'async' else StageUpdater)(provisioner)
+        update_plan = updater.resolve(args.organisation_name, args.azure_project_name, matcher)
+        update_plan.printTargets()
+        if update_plan.error is not None:
+            sys.exit(1)
+        if not update_plan.definitions:
+            return
+        if not args.yes and not teardown_provisioning.confirm("Update the stages of all " + str(len(update_plan.definitions)) + " release pipelines listed above? [yes/no]\n"):
+            sys.exit("Program exited by user")
+        report = updater.run(update_plan, stage_edit, args.user_email)
+    finally:
+        provisioner.close()
+    report.printSummary()
+    if report.failed:
+        sys.exit(1)
+
+def serveJobs(args):
+    import os
+    import secrets
+    import signal
+    from Provisioning.service import WarmProvisioner, ProvisioningService, JobServer, UnixJobServer
+    from Pipeline_Templates.store import TemplateStore
+    from Pipeline_Templates.languages import LanguageRegistry
+    from Pipeline_Templates.renderer import TemplateRenderer
+
+    try:
+        registry = LanguageRegistry(args.languages_file)
+    except (ValueError, KeyError) as error:
+        sys.exit(str(error.args[0]))
+    provisioner = WarmProvisioner(args.personal_access_token, max_workers=args.max_workers, identity_cache=args.identity_cache,
+                                  template_renderer=TemplateRenderer(TemplateStore(args.template_cache), registry), commit_mode=args.commit_mode,
+                                  metadata_cache=createMetadataCache(args))
+    token = args.token or os.environ.get('PROJECT_SETUP_SERVE_TOKEN')
+    if not token:
+        token = secrets.token_urlsafe(32)
+        print("Send every request with: Authorization: Bearer " + token, flush=True)
+    service = ProvisioningService(provisioner, registry, max_jobs=args.max_jobs).start()
+    try:
+        server = UnixJobServer(args.socket, service, token) if args.socket else JobServer((args.host, args.port), service, token)
+    except OSError as error:
+        service.stop()
+        sys.exit("Could not listen for jobs: " + str(error))
+    # Stopping with SIGTERM finishes the queued jobs and saves the caches, as Ctrl+C does
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print("Accepting jobs at " + server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("Finishing queued jobs", flush=True)
+        service.stop()
+
+def createOrDeleteProject(args):
+    import CICD_Providers.azure_devops as azure_devops_CICD
+    import Git_Providers.azure_devops as azure_devops_GIT
+    from Common.transport import AdoTransport
+    from Common.identity import IdentityResolver
+    from Common.context import AdoContext
+    from Common import tracing
+
+    template_renderer = None
+    if args.command == 'create':
+        from CICD_Providers.release_stages import ReleaseStageGraph
+        from Pipeline_Templates.store import TemplateStore
+        from Pipeline_Templates.languages import LanguageRegistry
+        from Pipeline_Templates.renderer import TemplateRenderer, parseVariables
+
+        try:
+            registry = LanguageRegistry(args.languages_file)
+            registry.get(args.language)
+            ReleaseStageGraph.fromSpecs(args.environment_names)
+            template_variables = {'environment_names': args.environment_names}
+            template_variables.update(parseVariables(args.template_variable))
+        except (ValueError, KeyError) as error:
+            sys.exit(str(error.args[0]))
+        template_renderer = TemplateRenderer(TemplateStore(args.template_cache), registry)
+
     organization_url = 'https://dev.azure.com/' + args.organisation_name
     base_url = organization_url + '/' + args.azure_project_name
 
-    build_pipeline = azure_devops_CICD.AzureDevops(args.azure_project_name, organization_url, args.personal_access_token)
-    git_repo = azure_devops_GIT.AzureDevopsGitRepo(args.azure_project_name, args.personal_access_token, organization_url)
+    transport = AdoTransport(args.personal_access_token, metadata_cache=createMetadataCache(args))
+    identity_resolver = IdentityResolver(transport, args.organisation_name, cache_path=getattr(args, 'identity_cache', None))
+    context = AdoContext(organization_url, args.azure_project_name, args.personal_access_token, transport=transport, identity_resolver=identity_resolver)
+    build_pipeline = azure_devops_CICD.AzureDevops(args.azure_project_name, organization_url, args.personal_access_token, context=context,
+                                                   template_renderer=template_renderer)
+    git_repo = azure_devops_GIT.AzureDevopsGitRepo(args.azure_project_name, args.personal_access_token, organization_url, context=context)
 
-    if args.command == 'create':
-        git_object = git_repo.createGitRepo(args.project_name)
-        build_pipeline.createBuildPipeline(args.project_name, args.personal_access_token, git_object)
-        build_pipeline.createReleasePipeline(args.project_name, args.environment_names, args.user_email)
-        build_pipeline.createPipelinesTemplate(args.project_name, args.language)
-    else:
-        git_repo.deleteGitRepo(args.project_name)
-        build_pipeline.deleteBuildPipeline(args.project_name, args.personal_access_token, base_url)
-        build_pipeline.deleteReleasePipeline(args.project_name)
+    try:
+        if args.command == 'create':
+            with tracing.phase('repo'):
+                git_object = git_repo.createGitRepo(args.project_name)
+            with tracing.phase('build'):
+                build_pipeline.createBuildPipeline(args.project_name, args.personal_access_token, git_object)
+            with tracing.phase('release'):
+                build_pipeline.createReleasePipeline(args.project_name, args.environment_names, args.user_email)
+            with tracing.phase('template'):
+                seed_files = azure_devops_GIT.readSeedFiles(args.seed_file)
+                build_pipeline.createPipelinesTemplate(args.project_name, args.language, git_repo=git_repo if args.commit_mode == 'api' else None,
+                                                       seed_files=seed_files, variables=template_variables)
+        else:
+            with tracing.phase('repo'):
+                git_repo.deleteGitRepo(args.project_name)
+            with tracing.phase('build'):
+                build_pipeline.deleteBuildPipeline(args.project_name, args.personal_access_token, base_url)
+            with tracing.phase('release'):
+                build_pipeline.deleteReleasePipeline(args.project_name)
+    finally:
+        transport.close()
+
+def createMetadataCache(args):
+    from Common.metadata_cache import MetadataCache, defaultCachePath
+
+    if args.no_metadata_cache:
+        return None
+    return MetadataCache(args.metadata_cache or defaultCachePath())
+
+def createProvisioner(args, **kwargs):
+    import Provisioning.batch as batch_provisioning
+
+    kwargs['metadata_cache'] = createMetadataCache(args)
+    try:
+        if args.engine == 'async':
+            return batch_provisioning.AsyncBatchProvisioner(args.personal_access_token, max_requests_per_host=args.max_requests_per_host, **kwargs)
+    except (ImportError, ValueError) as error:
+        sys.exit(str(error))
+    return batch_provisioning.BatchProvisioner(args.personal_access_token, max_workers=args.max_workers, **kwargs)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file